@@ -0,0 +1,77 @@
+# compares the exact closest approach solver of utils.get_overpass_track
+# with the Nelder-Mead optimization which overpass events use for stable event ids
+#
+# usage: python3 benchmark_overpass.py [-n REPEAT] [-f FLIGHT_ID]
+#
+# Without a flight id, a synthetic HALO track crossing a satellite track is used,
+# with a flight id, HALO navdata and the EarthCARE track of that flight are loaded.
+
+import time
+import numpy as np
+import xarray as xr
+
+from utils import get_overpass_track, nelder_mead_overpass
+
+
+def synthetic_tracks():
+    from orcestra.flightplan import geod
+    t0 = np.datetime64("2024-08-13T14:00:00", "ns")
+
+    halo_time = t0 + np.arange(8 * 3600) * np.timedelta64(1, "s")
+    az = np.where(np.arange(halo_time.size) < 4 * 3600, 170., 350.)
+    halo_lon, halo_lat = [-23.], [16.7]
+    for a in az[1:]:
+        lon, lat, _ = geod.fwd(halo_lon[-1], halo_lat[-1], a, 230.)
+        halo_lon.append(lon)
+        halo_lat.append(lat)
+
+    sat_seconds = np.arange(0, 3600, 10)
+    sat_time = halo_time[0] + (2 * 3600 + sat_seconds) * np.timedelta64(1, "s")
+    sat_lon, sat_lat, _ = geod.fwd(np.full(sat_time.size, -23.5),
+                                   np.full(sat_time.size, -30.),
+                                   np.full(sat_time.size, 5.),
+                                   7e3 * sat_seconds)
+
+    halo = xr.Dataset({"lat": ("time", np.array(halo_lat)), "lon": ("time", np.array(halo_lon))},
+                      coords={"time": halo_time})
+    sat = xr.Dataset({"lat": ("time", sat_lat), "lon": ("time", sat_lon)},
+                     coords={"time": sat_time})
+    return halo, sat
+
+
+def flight_tracks(flight_id):
+    from navdata import get_navdata_HALO
+    from utils import get_ec_track
+    ds = get_navdata_HALO(flight_id).load()
+    return ds, get_ec_track(flight_id, ds).load()
+
+
+def timed(f, repeat):
+    t = time.perf_counter()
+    for _ in range(repeat):
+        res = f()
+    return res, (time.perf_counter() - t) / repeat
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="benchmark closest approach between two tracks")
+    parser.add_argument("-n", "--repeat", type=int, default=5)
+    parser.add_argument("-f", "--flight_id", default=None)
+    args = parser.parse_args()
+
+    if args.flight_id is None:
+        a, b = synthetic_tracks()
+    else:
+        a, b = flight_tracks(args.flight_id)
+
+    (d_old, t_old), dt_old = timed(lambda: nelder_mead_overpass(a, b), args.repeat)
+    (d_new, t_new), dt_new = timed(lambda: get_overpass_track(a, b), args.repeat)
+
+    print(f"Nelder-Mead:      {d_old:10.1f} m @ {t_old}  {dt_old * 1e3:8.1f} ms")
+    print(f"closest approach: {d_new:10.1f} m @ {t_new}  {dt_new * 1e3:8.1f} ms")
+    print(f"speedup: {dt_old / dt_new:.0f}x")
+
+
+if __name__ == "__main__":
+    exit(main())
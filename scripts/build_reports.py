@@ -0,0 +1,105 @@
+# builds the reports of many flights in one go
+#
+# This produces the same files as running report.py per flight and index.py,
+# but imports and sets up everything only once and renders flights in parallel.
+
+import os
+import yaml
+
+from navdata import NAVDATA_GETTERS
+from report import build_report
+from sondes import load_sonde_info
+from index import build_index
+
+# keys which merge_segments.normalize_segmentation adds to a flight
+MERGED_ONLY_KEYS = ["name", "date", "flight_report", "contacts"]
+
+
+def flights_from_file(filename):
+    """
+    yields the segmentation of all flights in a segment file, which may either
+    be a single flight segment file or a merged file like all_flights.yaml.
+    Only flights of platforms with navigation data can be reported on.
+    """
+    with open(filename) as f:
+        meta = yaml.load(f, Loader=yaml.SafeLoader)
+
+    if "flight_id" in meta:
+        yield meta
+        return
+
+    for platform, flights in meta.items():
+        if platform not in NAVDATA_GETTERS:
+            continue
+        for flight in flights.values():
+            yield {k: v for k, v in flight.items() if k not in MERGED_ONLY_KEYS}
+
+
+def _build_report(task):
+    flightdata, outfile, sonde_info, asset_dir, use_plot_cache = task
+    plot_cache = None
+    if use_plot_cache:
+        from plotcache import PlotCache
+        plot_cache = PlotCache()
+    build_report(flightdata, outfile, sonde_info, asset_dir=asset_dir, plot_cache=plot_cache)
+    return outfile
+
+
+def build_reports(flights, outdir, sonde_info=None, jobs=1, asset_dir=None, use_plot_cache=True):
+    """
+    :param flights: list of flight segmentations
+    :param outdir: directory for the reports, named <flight_id>.html
+    :param sonde_info: list of sonde infos, looked up from IPFS if None
+    :param jobs: number of flights rendered in parallel
+    :param asset_dir: directory for plot images shared by all reports, plots are embedded if None
+    :param use_plot_cache: reuse segment plots from the local plot cache
+    :returns: list of written report filenames in order of `flights`
+    """
+    if sonde_info is None:
+        # the sonde table is updated here once, workers must not write it concurrently
+        from sondes import update_sonde_table
+        table = update_sonde_table([flight["flight_id"] for flight in flights])
+        flight_sondes = [table.sonde_info(flight["platform"], flight["flight_id"]) for flight in flights]
+    else:
+        flight_sondes = [sonde_info] * len(flights)
+    tasks = [(flight, os.path.join(outdir, f"{flight['flight_id']}.html"), sondes, asset_dir, use_plot_cache)
+             for flight, sondes in zip(flights, flight_sondes)]
+    if jobs > 1 and len(tasks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(jobs) as pool:
+            return list(pool.map(_build_report, tasks))
+    return [_build_report(task) for task in tasks]
+
+
+def _main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Build flight reports of many flights")
+    parser.add_argument("infiles", type=str, nargs="+", help="flight segment files or all_flights.yaml")
+    parser.add_argument("-o", "--outdir", default="reports", help="output directory")
+    parser.add_argument("-s", "--sonde_info", help="sonde info yaml file or sonde table", default=None)
+    parser.add_argument("-i", "--index", help="compiled segment file (all_flights.yaml) to build index.html from", default=None)
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="number of flights rendered in parallel")
+    parser.add_argument("-a", "--assets", default=None, help="write plots as image files into this directory instead of embedding them")
+    parser.add_argument("--no-plot-cache", action="store_true", help="render all plots, without using or storing cached plots")
+    args = parser.parse_args()
+
+    flights = [flight for filename in args.infiles for flight in flights_from_file(filename)]
+
+    if args.sonde_info is None:
+        sonde_info = None
+    else:
+        sonde_info = load_sonde_info(args.sonde_info)
+
+    os.makedirs(args.outdir, exist_ok=True)
+    for outfile in build_reports(flights, args.outdir, sonde_info, jobs=args.jobs, asset_dir=args.assets,
+                                 use_plot_cache=not args.no_plot_cache):
+        print(outfile)
+
+    if args.index is not None:
+        with open(args.index) as segmentfile:
+            meta = yaml.safe_load(segmentfile)
+        build_index(meta, os.path.join(args.outdir, "index.html"))
+
+
+if __name__ == "__main__":
+    _main()
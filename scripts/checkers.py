@@ -1,5 +1,30 @@
 import numpy as np
 
+# increase whenever checks change, such that cached verification results are invalidated
+CHECKER_VERSION = 4
+
+# thresholds of the navdata rules per segment kind, rules of all kinds of a segment apply
+NAVDATA_RULES = {
+    "circle": {"max_roll_deviation": 5., "max_alt_range": 200.},
+    "straight_leg": {"max_roll_deviation": 5., "max_alt_range": 200., "max_heading_std": 5.},
+    "ascent": {"min_alt_change": 100.},
+    "descent": {"max_alt_change": -100.},
+}
+# rules of all segments
+DEFAULT_NAVDATA_RULES = {"max_missing_fraction": .05}
+# rules which are not checked for segments with a remark starting with IRREGULARITY_TAG
+IRREGULARITY_RULES = ["max_roll_deviation", "max_alt_range", "max_heading_std"]
+IRREGULARITY_TAG = "irregularity:"
+# rules of level flight, not checked for segments which are also of a kind in VERTICAL_KINDS
+LEVEL_RULES = ["max_alt_range", "max_heading_std"]
+VERTICAL_KINDS = ["ascent", "descent"]
+# rules whose thresholds are not yet validated against the campaign navdata,
+# only checked by FlightChecker(..., uncalibrated=True), e.g. for reports
+UNCALIBRATED_RULES = ["max_roll_deviation", "max_alt_range", "max_heading_std",
+                      "min_alt_change", "max_alt_change", "max_missing_fraction"]
+# number of samples averaged at start and end of a segment for its altitude change
+ALT_CHANGE_SAMPLES = 30
+
 
 def kinds_is_circle(kinds):
     return any(k in kinds for k in ["circle", "circling"])
@@ -9,10 +34,76 @@ def has_irregularity(irregularities, irregularity_tag):
     return any(i.startswith(irregularity_tag) for i in irregularities)
 
 
+def navdata_rules(kinds):
+    """
+    :returns: dict of rule to threshold for a segment of `kinds`
+    """
+    rules = dict(DEFAULT_NAVDATA_RULES)
+    for kind in kinds:
+        rules.update(NAVDATA_RULES.get(kind, {}))
+    if any(kind in VERTICAL_KINDS for kind in kinds):
+        rules = {k: v for k, v in rules.items() if k not in LEVEL_RULES}
+    return rules
+
+
+def check_navdata(stats, start, end, kinds, remarks, uncalibrated=False):
+    """
+    checks the navdata of a segment against the rules of its kinds
+
+    :param stats: PrefixStats of the flight navdata
+    :param uncalibrated: also check UNCALIBRATED_RULES
+    """
+    rules = navdata_rules(kinds)
+    if not uncalibrated:
+        rules = {k: v for k, v in rules.items() if k not in UNCALIBRATED_RULES}
+    if has_irregularity(remarks, IRREGULARITY_TAG):
+        rules = {k: v for k, v in rules.items() if k not in IRREGULARITY_RULES}
+    i0, i1 = stats.indices(start, end)
+    if i1 - i0 < 2:
+        yield "segment contains no navdata"
+        return
+
+    if "max_missing_fraction" in rules and "alt" in stats.variables:
+        missing = stats.missing_fraction("alt", start, end)
+        if missing > rules["max_missing_fraction"]:
+            yield f"{missing:.0%} of navdata missing (max {rules['max_missing_fraction']:.0%})"
+    if "max_roll_deviation" in rules and "roll" in stats.variables:
+        deviation = stats.max_deviation("roll", i0, i1)
+        if deviation > rules["max_roll_deviation"]:
+            yield (f"roll deviates up to {deviation:.1f} deg from its mean of {stats.mean('roll', i0, i1):.1f} deg"
+                   f" (max {rules['max_roll_deviation']} deg)")
+    if "max_alt_range" in rules and "alt" in stats.variables:
+        alt_range = stats.range("alt", i0, i1)
+        if alt_range > rules["max_alt_range"]:
+            yield f"altitude varies by {alt_range:.0f} m (max {rules['max_alt_range']:.0f} m)"
+    if "max_heading_std" in rules and stats.has_heading:
+        heading_std = stats.heading_std(i0, i1)
+        if heading_std > rules["max_heading_std"]:
+            yield f"heading varies by {heading_std:.1f} deg standard deviation (max {rules['max_heading_std']} deg)"
+    if "alt" in stats.variables and ("min_alt_change" in rules or "max_alt_change" in rules):
+        # mean altitudes of the first and last samples are robust against noise
+        n = min(ALT_CHANGE_SAMPLES, i1 - i0)
+        alt_change = stats.mean("alt", i1 - n, i1) - stats.mean("alt", i0, i0 + n)
+        if alt_change < rules.get("min_alt_change", -np.inf):
+            yield f"altitude changes by {alt_change:.0f} m, expected an ascent of at least {rules['min_alt_change']:.0f} m"
+        if alt_change > rules.get("max_alt_change", np.inf):
+            yield f"altitude changes by {alt_change:.0f} m, expected a descent of at least {-rules['max_alt_change']:.0f} m"
+
+
 class FlightChecker:
-    def __init__(self, flight):
+    def __init__(self, flight, navdata=None, uncalibrated=False):
+        """
+        :param navdata: optional navdata of the flight, enables the checks of NAVDATA_RULES
+        :param uncalibrated: also check UNCALIBRATED_RULES
+        """
         self.used_segment_ids = set()
         self.flight_id = flight.get("flight_id", "")
+        self.uncalibrated = uncalibrated
+        if navdata is not None:
+            from navstats import PrefixStats
+            self.stats = PrefixStats(navdata)
+        else:
+            self.stats = None
 
     def check_flight(self, flight):
         if "flight_id" not in flight:
@@ -63,3 +154,7 @@ class FlightChecker:
         else:
             yield "segment has no remarks attribute"
             remarks = []
+
+        if self.stats is not None and seg["end"] > seg["start"]:
+            yield from check_navdata(self.stats, seg["start"], seg["end"], seg.get("kinds", []), remarks,
+                                      uncalibrated=self.uncalibrated)
@@ -0,0 +1,210 @@
+# detection of takeoff, landing, climbs, descents and ground periods of a flight
+#
+# The airport of takeoff and landing is looked up from the date tables below,
+# all phases are found in one pass over the altitude with threshold crossings
+# and run lengths. Results are cached per flight and navdata content:
+#
+#     python3 flightphases.py [FLIGHT_ID ...]
+
+import hashlib
+import json
+import numpy as np
+
+from localcache import cache_dir, DiskLRU
+
+__all__ = ["flight_phases", "airport", "runs", "centered_rate"]
+
+# WGS84 altitude thresholds of the airports, aircraft above are considered airborne
+AIRPORT_ALTITUDES = {
+    "Memmingen": 681,
+    "Oberpfaffenhofen": 630,
+    "Sal": 90,
+    "Barbados": 9,
+}
+
+# (from, until, flight_id contains, airport), the first matching rule applies,
+# the takeoff rules apply to the first navdata time, the landing rules to the last
+TAKEOFF_AIRPORTS = [
+    (None, "2024-08-10", None, "Memmingen"),        # Transfer flight to Sal
+    ("2024-11-01", None, "b", "Memmingen"),         # Two November flights
+    ("2024-11-01", None, None, "Oberpfaffenhofen"), # All other November flights
+    ("2024-08-10", "2024-09-07", None, "Sal"),
+    ("2024-09-07", None, None, "Barbados"),
+]
+LANDING_AIRPORTS = [
+    (None, "2024-09-05", None, "Sal"),
+    ("2024-09-05", "2024-09-29", None, "Barbados"),
+    ("2024-11-01", None, None, "Oberpfaffenhofen"), # All other November flights
+    ("2024-09-30", "2024-10-01", None, "Memmingen"),# Transfer back from Barbados
+]
+
+# minimum vertical speed (m/s) and duration of climbs and descents
+VERTICAL_SPEED = 2.
+MIN_VERTICAL_DURATION = np.timedelta64(60, "s")
+VERTICAL_SPEED_WINDOW = 30
+
+# change to invalidate cached phases
+PHASES_VERSION = 1
+
+
+def airport(rules, flight_id, time):
+    """
+    :param rules: TAKEOFF_AIRPORTS or LANDING_AIRPORTS
+    :returns: name of the airport
+    :raises LookupError: if no rule matches
+    """
+    time = np.datetime64(time, "ns")
+    for start, end, contains, name in rules:
+        if ((start is None or time >= np.datetime64(start, "ns"))
+                and (end is None or time < np.datetime64(end, "ns"))
+                and (contains is None or contains in flight_id)):
+            return name
+    raise LookupError(f"no airport known for {flight_id} at {time}")
+
+
+def runs(mask):
+    """
+    :returns: start and (exclusive) end indices of all runs of True in `mask`
+    """
+    d = np.diff(np.concatenate([[0], np.asarray(mask, dtype=np.int8), [0]]))
+    return np.flatnonzero(d == 1), np.flatnonzero(d == -1)
+
+
+def centered_rate(time, values, window):
+    """
+    :returns: rate of change per second of `values` by centered differences over `window` samples,
+              shortened at the ends
+    """
+    i = np.arange(len(values))
+    i0 = np.maximum(i - window // 2, 0)
+    i1 = np.minimum(i + window // 2, len(values) - 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (values[i1] - values[i0]) / ((time[i1] - time[i0]) / np.timedelta64(1, "s"))
+
+
+def _periods(time, mask, min_duration=None):
+    start, end = runs(mask)
+    periods = [(time[s], time[e - 1]) for s, e in zip(start, end)]
+    if min_duration is not None:
+        periods = [(s, e) for s, e in periods if e - s >= min_duration]
+    return periods
+
+
+def detect_phases(flight_id, time, alt):
+    """
+    :param time: navdata times (datetime64[ns])
+    :param alt: WGS84 altitude
+    :returns: dict of takeoff, landing, duration (minutes), the airports and lists of
+              (start, end) of climbs, descents, ground periods and gaps of altitude data
+    """
+    time = np.asarray(time, dtype="datetime64[ns]")
+    alt = np.asarray(alt, dtype=float)
+
+    takeoff_airport = airport(TAKEOFF_AIRPORTS, flight_id, time[0])
+    landing_airport = airport(LANDING_AIRPORTS, flight_id, time[-1])
+    takeoff_alt = AIRPORT_ALTITUDES[takeoff_airport]
+    landing_alt = AIRPORT_ALTITUDES[landing_airport]
+
+    airborne = alt > takeoff_alt
+    if not airborne.any():
+        raise ValueError(f"{flight_id} never exceeds the takeoff altitude of {takeoff_airport}")
+    i_takeoff = np.argmax(airborne)
+    landed = (alt <= landing_alt) & (np.arange(len(alt)) > i_takeoff)
+    # handle exception of missing BAHAMAS data at end of flight
+    i_landing = np.argmax(landed) if landed.any() else len(alt) - 1
+
+    takeoff, landing = time[i_takeoff], time[i_landing]
+
+    # centered differences over VERTICAL_SPEED_WINDOW samples smooth out altitude noise
+    vertical_speed = centered_rate(time, alt, VERTICAL_SPEED_WINDOW)
+
+    return {
+        "takeoff": takeoff,
+        "landing": landing,
+        "duration": int((landing - takeoff).astype("timedelta64[m]").astype(int)),
+        "takeoff_airport": takeoff_airport,
+        "landing_airport": landing_airport,
+        "climbs": _periods(time, vertical_speed > VERTICAL_SPEED, MIN_VERTICAL_DURATION),
+        "descents": _periods(time, vertical_speed < -VERTICAL_SPEED, MIN_VERTICAL_DURATION),
+        "ground": _periods(time, alt <= max(takeoff_alt, landing_alt)),
+        "gaps": _periods(time, np.isnan(alt)),
+    }
+
+
+def _to_json(phases):
+    def t(v):
+        return str(v) if isinstance(v, np.datetime64) else v
+    return json.dumps({k: [[t(s), t(e)] for s, e in v] if isinstance(v, list) else t(v)
+                       for k, v in phases.items()}).encode("utf-8")
+
+
+def _from_json(data):
+    def t(v):
+        return np.datetime64(v, "ns")
+    phases = json.loads(data)
+    return {k: [(t(s), t(e)) for s, e in v] if isinstance(v, list)
+               else t(v) if k in ["takeoff", "landing"] else v
+            for k, v in phases.items()}
+
+
+_phases = {}
+
+def flight_phases(flight_id, ds, cache=None):
+    """
+    :param ds: navdata of the flight
+    :returns: phases of the flight as returned by `detect_phases`,
+              cached by flight and navdata content
+    """
+    time = ds["time"].values.astype("datetime64[ns]")
+    alt = ds["alt"].values.astype(float)
+    h = hashlib.sha256()
+    h.update(time.tobytes())
+    h.update(alt.tobytes())
+    key = f"{flight_id}/{h.hexdigest()}/phases version {PHASES_VERSION}"
+
+    if key not in _phases:
+        cache = cache or DiskLRU(cache_dir("phases"), "100M")
+        data = cache.get(key)
+        if data is None:
+            phases = detect_phases(flight_id, time, alt)
+            cache.put(key, _to_json(phases))
+        else:
+            phases = _from_json(data)
+        _phases[key] = phases
+    return _phases[key]
+
+
+def campaign_phases(flight_ids, jobs=8):
+    """
+    :returns: dict of flight_id to the phases of all given HALO flights
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from navdata import get_navdata_HALO
+    cache = DiskLRU(cache_dir("phases"), "100M")
+
+    def phases(flight_id):
+        return flight_phases(flight_id, get_navdata_HALO(flight_id)[["alt"]].load(), cache=cache)
+
+    with ThreadPoolExecutor(jobs) as pool:
+        return dict(zip(flight_ids, pool.map(phases, flight_ids)))
+
+
+def _main():
+    import argparse
+    parser = argparse.ArgumentParser(description="detect takeoff, landing and flight phases")
+    parser.add_argument("flight_ids", nargs="*", help="HALO flights (default: all with segmentation notebook)")
+    parser.add_argument("-j", "--jobs", type=int, default=8, help="number of flights loaded concurrently")
+    args = parser.parse_args()
+
+    flight_ids = args.flight_ids
+    if not flight_ids:
+        from navdata import segmented_flights_HALO
+        flight_ids = segmented_flights_HALO()
+
+    for flight_id, p in campaign_phases(flight_ids, args.jobs).items():
+        print(f"{flight_id}: {p['takeoff_airport']} {p['takeoff']} -> {p['landing_airport']} {p['landing']}"
+              f" ({p['duration']} min, {len(p['climbs'])} climbs, {len(p['descents'])} descents)")
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,196 @@
+# columnar companion tables of the compiled segment file (all_flights.yaml)
+#
+# merge_segments.py writes three parquet files next to the yaml file:
+#
+#     all_flights.flights.parquet   one row per flight
+#     all_flights.segments.parquet  one row per segment and kind
+#     all_flights.events.parquet    one row per event and kind
+#
+# Segments and events without kinds have one row with kind None. `position` is
+# the index of a segment or event within its flight, such that rows of the same
+# segment or event can be identified. Segment statistics (see segmentstats.py)
+# are NaN for segments without them.
+
+import os
+
+from segmentstats import STATS
+
+__all__ = ["tables_from_meta", "write_tables", "load_tables", "segments_of_kind",
+           "circle_count", "total_duration", "kind_stats"]
+
+TABLES = ["flights", "segments", "events"]
+
+FLIGHT_COLUMNS = ["platform", "flight_id", "mission", "name", "date", "takeoff", "landing",
+                  "flight_report", "remarks"]
+SEGMENT_COLUMNS = ["platform", "flight_id", "position", "segment_id", "name", "start", "end",
+                   "kind", "remarks", "clat", "clon", "radius", *STATS]
+EVENT_COLUMNS = ["platform", "flight_id", "position", "event_id", "name", "time",
+                 "kind", "distance", "remarks"]
+
+TIME_COLUMNS = {"flights": ["takeoff", "landing"], "segments": ["start", "end"], "events": ["time"]}
+FLOAT_COLUMNS = {"flights": [], "segments": ["clat", "clon", "radius", *STATS], "events": ["distance"]}
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [value]
+    return [str(v) for v in value]
+
+
+def _str_or_none(value):
+    return None if value is None else str(value)
+
+
+def tables_from_meta(meta):
+    """
+    :param meta: content of the compiled segment file, platform -> flight_id -> flight
+    :returns: dict of table name to DataFrame
+    """
+    import pandas as pd
+    flights, segments, events = [], [], []
+    for platform, platform_flights in meta.items():
+        for flight_id, flight in platform_flights.items():
+            flights.append({"platform": platform,
+                            "flight_id": flight_id,
+                            "mission": flight.get("mission"),
+                            "name": _str_or_none(flight.get("name")),
+                            "date": _str_or_none(flight.get("date")),
+                            "takeoff": flight.get("takeoff"),
+                            "landing": flight.get("landing"),
+                            "flight_report": flight.get("flight_report"),
+                            "remarks": _as_list(flight.get("remarks"))})
+            for position, s in enumerate(flight.get("segments") or []):
+                for kind in _as_list(s.get("kinds")) or [None]:
+                    segments.append({"platform": platform,
+                                     "flight_id": flight_id,
+                                     "position": position,
+                                     "segment_id": s.get("segment_id"),
+                                     "name": _str_or_none(s.get("name")),
+                                     "start": s.get("start"),
+                                     "end": s.get("end"),
+                                     "kind": kind,
+                                     "remarks": _as_list(s.get("remarks")),
+                                     "clat": s.get("clat"),
+                                     "clon": s.get("clon"),
+                                     "radius": s.get("radius"),
+                                     **{k: (s.get("stats") or {}).get(k) for k in STATS}})
+            for position, e in enumerate(flight.get("events") or []):
+                for kind in _as_list(e.get("kinds")) or [None]:
+                    events.append({"platform": platform,
+                                   "flight_id": flight_id,
+                                   "position": position,
+                                   "event_id": e.get("event_id"),
+                                   "name": _str_or_none(e.get("name")),
+                                   "time": e.get("time"),
+                                   "kind": kind,
+                                   "distance": e.get("distance"),
+                                   "remarks": _as_list(e.get("remarks"))})
+
+    tables = {"flights": pd.DataFrame.from_records(flights, columns=FLIGHT_COLUMNS),
+              "segments": pd.DataFrame.from_records(segments, columns=SEGMENT_COLUMNS),
+              "events": pd.DataFrame.from_records(events, columns=EVENT_COLUMNS)}
+    for name, df in tables.items():
+        for c in TIME_COLUMNS[name]:
+            df[c] = pd.to_datetime(df[c]).astype("datetime64[ns]")
+        for c in FLOAT_COLUMNS[name]:
+            df[c] = df[c].astype(float)
+        if "position" in df:
+            df["position"] = df["position"].astype("int64")
+    return tables
+
+
+def table_paths(segmentfile):
+    """
+    :returns: dict of table name to the parquet file next to `segmentfile`
+    """
+    base = os.path.splitext(segmentfile)[0]
+    return {name: f"{base}.{name}.parquet" for name in TABLES}
+
+
+def write_tables(meta, segmentfile):
+    """
+    writes the companion tables of the compiled segment file `segmentfile`
+    """
+    paths = table_paths(segmentfile)
+    for name, df in tables_from_meta(meta).items():
+        df.to_parquet(paths[name] + ".tmp", index=False)
+        os.replace(paths[name] + ".tmp", paths[name])
+    return paths
+
+
+def has_tables(segmentfile):
+    """
+    True if all companion tables exist and are not older than `segmentfile`
+    """
+    paths = table_paths(segmentfile).values()
+    return all(os.path.exists(p) and os.path.getmtime(p) >= os.path.getmtime(segmentfile) for p in paths)
+
+
+def load_tables(segmentfile):
+    """
+    :param segmentfile: compiled segment file, whose companion tables are loaded
+    :returns: dict of table name to DataFrame
+    """
+    import pandas as pd
+    return {name: pd.read_parquet(path) for name, path in table_paths(segmentfile).items()}
+
+
+def segments_of_kind(segments, kind):
+    """
+    :param segments: segments table
+    :returns: one row per segment having `kind`, with its other kinds dropped
+    """
+    return segments[segments["kind"] == kind].drop_duplicates(["platform", "flight_id", "position"])
+
+
+def flights_by_platform(flights):
+    """
+    :param flights: flights table
+    :returns: dict of platform to dict of flight_id to flight row, in table order
+    """
+    by_platform = {}
+    for row in flights.to_dict("records"):
+        by_platform.setdefault(row["platform"], {})[row["flight_id"]] = row
+    return by_platform
+
+
+def circle_count(segments):
+    """
+    :returns: number of segments of kind circle
+    """
+    return len(segments_of_kind(segments, "circle"))
+
+
+def total_duration(flights):
+    """
+    :returns: sum of flight durations (takeoff to landing) in hours
+    """
+    ns = (flights["landing"].values - flights["takeoff"].values).astype("timedelta64[ns]").astype("int64")
+    return int(ns.sum()) / 3600e9
+
+
+def kind_stats(segments):
+    """
+    :param segments: segments table
+    :returns: DataFrame of segment count, hours, distance (km), duration weighted mean
+              altitude (m) and sonde count per platform and kind, of segments with statistics.
+              Values are NaN where no segment of the group has them, e.g. sonde counts
+              of merges without sonde info.
+    """
+    segments = segments[segments["duration"].notna() & segments["kind"].notna()]
+    weighted_alt = (segments["alt_mean"] * segments["duration"]).where(segments["alt_mean"].notna())
+    alt_duration = segments["duration"].where(segments["alt_mean"].notna())
+    grouped = segments.assign(weighted_alt=weighted_alt, alt_duration=alt_duration) \
+                      .groupby(["platform", "kind"], sort=True)
+    stats = grouped.agg(count=("position", "size"),
+                        duration=("duration", "sum"),
+                        distance=("distance", lambda x: x.sum(min_count=1)),
+                        weighted_alt=("weighted_alt", lambda x: x.sum(min_count=1)),
+                        alt_duration=("alt_duration", lambda x: x.sum(min_count=1)),
+                        sonde_count=("sonde_count", lambda x: x.sum(min_count=1)))
+    return stats.assign(hours=stats["duration"] / 3600,
+                        distance=stats["distance"] / 1000,
+                        alt_mean=stats["weighted_alt"] / stats["alt_duration"]) \
+                [["count", "hours", "distance", "alt_mean", "sonde_count"]].reset_index()
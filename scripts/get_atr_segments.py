@@ -1,22 +1,116 @@
+import os
+import json
+import asyncio
 import fsspec
 import yaml
 
+from localcache import cache_dir
+
 aeris = "https://observations.ipsl.fr/aeris/maestro/data/insitu/AIRCRAFT/ATR/YAML/"
 
+# response headers which identify the version of a remote file
+VERSION_KEYS = ["size", "ETag", "Last-Modified"]
+
+
+def remote_version(info):
+    return {k: info[k] for k in VERSION_KEYS if info.get(k) is not None}
+
+
+def is_unchanged(entry, info, outdir):
+    """
+    True if the remote file described by `info` is known from the manifest
+    `entry` and has been written to `outdir` before
+    """
+    version = remote_version(info)
+    return (entry is not None
+            and len(version) > 0
+            and entry["version"] == version
+            and os.path.exists(os.path.join(outdir, entry["filename"])))
+
+
+async def _fetch(url, manifest, outdir, jobs):
+    """
+    :returns: list of (url, info, content) for all new or changed files
+    """
+    fs = fsspec.filesystem("http", asynchronous=True)
+    session = await fs.set_session()
+    semaphore = asyncio.Semaphore(jobs)
+
+    async def info(f):
+        async with semaphore:
+            return await fs._info(f)
+
+    async def cat(f):
+        async with semaphore:
+            return await fs._cat_file(f)
+
+    try:
+        files = await fs._ls(url, detail=False)
+        yamlfiles = [f for f in files if f[-4:] == "yaml"]
+        infos = await asyncio.gather(*[info(f) for f in yamlfiles])
+        changed = [(f, i) for f, i in zip(yamlfiles, infos)
+                   if not is_unchanged(manifest.get(f), i, outdir)]
+        contents = await asyncio.gather(*[cat(f) for f, _ in changed])
+    finally:
+        await session.close()
+
+    return [(f, i, content) for (f, i), content in zip(changed, contents)]
+
+
+def sync(url=aeris, outdir="./flight_segment_files", manifest_file=None, jobs=8):
+    """
+    Downloads the ATR segment files from `url` into `outdir`.
+
+    Files with unchanged size, ETag and Last-Modified according to the manifest
+    of the previous sync are not downloaded again, and output files are only
+    rewritten if their content changes.
+
+    :returns: list of written files
+    """
+    if manifest_file is None:
+        manifest_file = os.path.join(cache_dir("atr"), "manifest.json")
+    try:
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        manifest = {}
+
+    written = []
+    for file, info, content in asyncio.run(_fetch(url, manifest, outdir, jobs)):
+        meta = yaml.safe_load(content)
+        filename = f"{meta['safire_flight_id']}.yaml"
+        text = yaml.dump(meta, sort_keys=False)
+
+        path = os.path.join(outdir, filename)
+        try:
+            with open(path) as f:
+                old_text = f.read()
+        except FileNotFoundError:
+            old_text = None
+        if text != old_text:
+            with open(path, "w") as f:
+                f.write(text)
+            written.append(path)
+
+        manifest[file] = {"filename": filename, "version": remote_version(info)}
+
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    return written
+
 
 def __main__():
-    fs = fsspec.filesystem("http")
-    files = fs.ls(aeris, detail=False)
-    yamlfiles = [f for f in files if f[-4:] == "yaml"]
-
-    for file in yamlfiles:
-        with fsspec.open(file) as f:
-            meta = yaml.safe_load(f)
-            yaml.dump(
-                meta,
-                open(f"./flight_segment_files/{meta['safire_flight_id']}.yaml", "w"),
-                sort_keys=False,
-            )
+    import argparse
+    parser = argparse.ArgumentParser(description="Sync ATR segmentation files from AERIS")
+    parser.add_argument("-u", "--url", default=aeris, help="directory listing of ATR segment files")
+    parser.add_argument("-o", "--outdir", default="./flight_segment_files", help="output directory")
+    parser.add_argument("-m", "--manifest", default=None, help="manifest of the previous sync")
+    parser.add_argument("-j", "--jobs", type=int, default=8, help="number of concurrent requests")
+    args = parser.parse_args()
+
+    for path in sync(args.url, args.outdir, args.manifest, args.jobs):
+        print(f"updated {path}")
 
 
 if __name__ == "__main__":
@@ -1,10 +1,148 @@
-import xarray as xr
+# access to the PACE satellite track by time window and lat/lon box
+#
+# The track is cached locally in blocks (BLOCK long) of a UTC day. Every day comes
+# with a small index of the lat/lon bounds of its blocks, so a query only reads the
+# cached blocks which intersect the requested window and box, and the remote zarr
+# store is read only once per day.
+
+import io
+import json
+import numpy as np
+
+from ipfscache import open_zarr
+from localcache import cache_dir, DiskLRU
+
+PACE_ROOT = "ipfs://QmfMH7HJveBJsHERphikd2QnswE2bTtyZo12tap5vbfsvS"
+BLOCK = np.timedelta64(10, "m")
+
+
+def open_pace():
+    return open_zarr(PACE_ROOT)
+
+
+def _cache():
+    return DiskLRU(cache_dir("pace"), "2G")
+
+
+def _datetime64(t):
+    import pandas as pd
+    t = pd.Timestamp(t)
+    if t.tzinfo is not None:
+        t = t.tz_convert("UTC").tz_localize(None)
+    return t.to_datetime64().astype("datetime64[ns]")
+
+
+def _block_numbers(df, day):
+    return (df.index.values.astype("datetime64[ns]") - day) // BLOCK
+
+
+def _index_key(day):
+    return f"{PACE_ROOT}/{day}/index"
+
+
+def _block_key(day, block):
+    return f"{PACE_ROOT}/{day}/{block}"
+
+
+def _load_day(day, cache):
+    """
+    reads all track variables of a UTC day from the remote store and caches them
+    as one entry per block, together with the index of the day
+
+    :returns: the index of the day, see `_day_index`
+    """
+    next_day = day + np.timedelta64(1, "D")
+    ds = open_pace().sel(time=slice(day, next_day))
+    df = ds[[v for v in ds.data_vars if ds[v].dims == ("time",)]].to_dataframe()
+    df = df[df.index < next_day]
+
+    blocks = []
+    for b, block in df.groupby(_block_numbers(df, day)):
+        lat, lon = block["lat"], block["lon"]
+        # blocks without positions never intersect a lat/lon box
+        if lat.isna().all() or lon.isna().all():
+            continue
+        buf = io.BytesIO()
+        block.to_parquet(buf)
+        cache.put(_block_key(day, int(b)), buf.getvalue())
+        blocks.append([int(b), float(lat.min()), float(lat.max()), float(lon.min()), float(lon.max())])
+    index = {"columns": list(df.columns), "blocks": blocks}
+    cache.put(_index_key(day), json.dumps(index).encode("utf-8"))
+    return index
+
+
+def _day_index(day, cache):
+    """
+    :returns: dict with the columns of the day and a list of
+              [block, lat_min, lat_max, lon_min, lon_max] of its blocks
+    """
+    data = cache.get(_index_key(day))
+    if data is not None:
+        return json.loads(data)
+    return _load_day(day, cache)
+
+
+def _read_blocks(day, blocks, cache):
+    """
+    :returns: DataFrames of the given blocks of a UTC day, read from the cache only
+    """
+    import pandas as pd
+    data = [cache.get(_block_key(day, b)) for b in blocks]
+    if any(d is None for d in data):
+        # blocks were evicted from the cache
+        _load_day(day, cache)
+        data = [cache.get(_block_key(day, b)) for b in blocks]
+    return [pd.read_parquet(io.BytesIO(d)) for d in data]
+
+
+def _overlaps(lo, hi, value_range):
+    return value_range is None or (lo < value_range[1] and hi > value_range[0])
+
+
+def get_pace_track(t_start, t_end, lat_range=None, lon_range=None):
+    """
+    :param lat_range: optional (min, max) latitude of the returned track points
+    :param lon_range: optional (min, max) longitude of the returned track points
+    :returns: PACE track in [t_start, t_end] within the given lat/lon box
+    """
+    import pandas as pd
+    t_start, t_end = _datetime64(t_start), _datetime64(t_end)
+    cache = _cache()
+
+    parts = []
+    columns = []
+    for day in np.arange(t_start.astype("datetime64[D]"), t_end.astype("datetime64[D]") + 1):
+        day = day.astype("datetime64[ns]")
+        index = _day_index(day, cache)
+        columns = index["columns"]
+        blocks = [b for b, lat_min, lat_max, lon_min, lon_max in index["blocks"]
+                  if day + b * BLOCK <= t_end and day + (b + 1) * BLOCK > t_start
+                  and _overlaps(lat_min, lat_max, lat_range)
+                  and _overlaps(lon_min, lon_max, lon_range)]
+        parts.extend(_read_blocks(day, blocks, cache))
+
+    if parts:
+        df = pd.concat(parts)
+    else:
+        df = pd.DataFrame({c: pd.Series(dtype=float) for c in columns},
+                          index=pd.DatetimeIndex([], name="time"))
+    mask = (df.index >= t_start) & (df.index <= t_end)
+    if lat_range is not None:
+        mask &= (df.lat > lat_range[0]) & (df.lat < lat_range[1])
+    if lon_range is not None:
+        mask &= (df.lon > lon_range[0]) & (df.lon < lon_range[1])
+    return df[mask].to_xarray()
+
+
+def pace_track_near(ds, margin=2., t_start=None, t_end=None):
+    """
+    :returns: PACE track during a flight within `margin` degrees of the flight track `ds`
+    """
+    return get_pace_track(ds.time.values[0] if t_start is None else t_start,
+                          ds.time.values[-1] if t_end is None else t_end,
+                          lat_range=(float(ds.lat.min()) - margin, float(ds.lat.max()) + margin),
+                          lon_range=(float(ds.lon.min()) - margin, float(ds.lon.max()) + margin))
 
-def get_pace_track(t_start, t_end):
-    return xr.open_dataset(
-        "ipfs://QmfMH7HJveBJsHERphikd2QnswE2bTtyZo12tap5vbfsvS",
-        engine="zarr",
-    ).sel(time=slice(t_start, t_end))
 
 def main():
     from datetime import datetime, UTC
@@ -1,5 +1,4 @@
 import os
-import datetime
 import yaml
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 
@@ -8,6 +7,35 @@ env = Environment(
     autoescape=select_autoescape(['html', 'xml'])
 )
 
+def fixed(value, digits=0):
+    """formats a number with `digits` decimals, "–" if it is missing"""
+    if value is None or value != value:
+        return "–"
+    return f"{value:.{digits}f}"
+
+env.filters["fixed"] = fixed
+
+def build_index(meta, outfile, tables=None):
+    """
+    renders the index page
+
+    :param meta: content of the compiled segment file (all_flights.yaml), or platform -> flight_id -> flight
+    :param outfile: output html filename
+    :param tables: companion tables of the compiled segment file, computed from `meta` if not given
+    """
+    import flighttables
+    tpl = env.get_template("index.html")
+
+    if tables is None:
+        tables = flighttables.tables_from_meta(meta)
+    circle_count = flighttables.circle_count(tables["segments"])
+    total_duration = flighttables.total_duration(tables["flights"])
+    kind_stats = flighttables.kind_stats(tables["segments"]).to_dict("records")
+
+    with open(outfile, "w") as f:
+        f.write(tpl.render(meta=meta, circle_count=circle_count, total_duration=total_duration,
+                           kind_stats=kind_stats))
+
 def _main():
     import argparse
     parser = argparse.ArgumentParser()
@@ -15,24 +43,16 @@ def _main():
     parser.add_argument("-s", "--segmentfile", default="all_flights.yaml", help="compiled segment file")
     args = parser.parse_args()
 
-    tpl = env.get_template("index.html")
-
-    with open(args.segmentfile) as segmentfile:
-        meta = yaml.safe_load(segmentfile)
-
-    circle_count = len([segment
-                        for flights in meta.values()
-                        for flight in flights.values()
-                        for segment in flight["segments"]
-                        if "circle" in segment["kinds"]])
-
-    total_duration = sum([flight["landing"] - flight["takeoff"]
-                          for flights in meta.values()
-                          for flight in flights.values()], start=datetime.timedelta(0))
-
+    import flighttables
+    if flighttables.has_tables(args.segmentfile):
+        tables = flighttables.load_tables(args.segmentfile)
+        meta = flighttables.flights_by_platform(tables["flights"])
+    else:
+        with open(args.segmentfile) as segmentfile:
+            meta = yaml.safe_load(segmentfile)
+        tables = None
 
-    with open(args.outfile, "w") as outfile:
-        outfile.write(tpl.render(meta=meta, circle_count=circle_count, total_duration=total_duration / datetime.timedelta(hours=1)))
+    build_index(meta, args.outfile, tables)
 
 if __name__ == "__main__":
     _main()
@@ -0,0 +1,120 @@
+# read-through cache for ipfs:// inputs
+#
+# everything below a CID is immutable, so objects and directory listings
+# fetched once can be reused forever. They are kept in a size limited
+# local cache (see localcache.DiskLRU) which makes repeated builds run at
+# local disk speed and allows to rebuild everything offline once the
+# cache is warm (set FLIGHTSEG_OFFLINE=1).
+
+import os
+import io
+import json
+import fsspec
+from fsspec.spec import AbstractFileSystem
+
+from localcache import CacheMiss, cache_dir, offline as offline_mode, DiskLRU
+
+__all__ = ["CacheMiss", "CachingIPFSFileSystem", "get_filesystem", "get_mapper", "open_zarr"]
+
+
+def is_immutable(path):
+    root = path.split("/", 1)[0]
+    return root.startswith("Qm") or root.startswith("bafy")
+
+
+class CachingIPFSFileSystem(AbstractFileSystem):
+    """
+    fsspec filesystem serving ipfs:// paths from a local cache.
+
+    :param cache_path: cache directory, defaults to <FLIGHTSEG_CACHE_DIR>/ipfs
+    :param max_size: size budget of the cache, defaults to $FLIGHTSEG_IPFS_CACHE_SIZE or 20G
+    :param offline: only use cached data, defaults to $FLIGHTSEG_OFFLINE
+    :param upstream: filesystem to read uncached data from, defaults to the "ipfs"
+                     filesystem of ipfsspec. Any filesystem accepting "<CID>/<path>"
+                     works, e.g. a DirFileSystem on a local directory as stand-in for
+                     a gateway.
+    """
+    protocol = "ipfs"
+    root_marker = ""
+
+    def __init__(self, cache_path=None, max_size=None, offline=None, upstream=None, **kwargs):
+        super().__init__(**kwargs)
+        self.store = DiskLRU(cache_path or cache_dir("ipfs"),
+                             max_size or os.environ.get("FLIGHTSEG_IPFS_CACHE_SIZE", "20G"))
+        self.offline = offline_mode() if offline is None else offline
+        self._upstream = upstream
+
+    @property
+    def upstream(self):
+        if self._upstream is None:
+            self._upstream = fsspec.filesystem("ipfs")
+        return self._upstream
+
+    def _fetch(self, key, path, fetch):
+        """
+        returns cached bytes for `key` or stores the result of `fetch()`.
+        Missing files are remembered as well, such that zarr's probing for
+        optional metadata keys also works offline.
+        """
+        cacheable = is_immutable(path)
+        if cacheable:
+            data = self.store.get(key)
+            if data is not None:
+                if data == b"\0missing":
+                    raise FileNotFoundError(path)
+                return data
+        if self.offline:
+            raise CacheMiss(f"{path} is not cached and FLIGHTSEG_OFFLINE is set")
+        try:
+            data = fetch()
+        except FileNotFoundError:
+            if cacheable:
+                self.store.put(key, b"\0missing")
+            raise
+        if cacheable:
+            self.store.put(key, data)
+        return data
+
+    def cat_file(self, path, start=None, end=None, **kwargs):
+        path = self._strip_protocol(path)
+        data = self._fetch("cat:" + path, path, lambda: self.upstream.cat_file(path))
+        if start is not None or end is not None:
+            data = data[start:end]
+        return data
+
+    def ls(self, path, detail=True, **kwargs):
+        path = self._strip_protocol(path)
+
+        def fetch():
+            entries = self.upstream.ls(path, detail=True)
+            return json.dumps([{**e, "name": self._strip_protocol(e["name"])}
+                               for e in entries], default=str).encode("utf-8")
+
+        entries = json.loads(self._fetch("ls:" + path, path, fetch))
+        if detail:
+            return entries
+        return [e["name"] for e in entries]
+
+    def _open(self, path, mode="rb", **kwargs):
+        if mode != "rb":
+            raise NotImplementedError("the IPFS cache is read only")
+        return io.BytesIO(self.cat_file(path))
+
+
+def get_filesystem(**kwargs):
+    """
+    :returns: a caching filesystem for ipfs:// paths, see CachingIPFSFileSystem for options
+    """
+    return CachingIPFSFileSystem(**kwargs)
+
+
+def get_mapper(url, **kwargs):
+    return get_filesystem(**kwargs).get_mapper(url)
+
+
+def open_zarr(url, **kwargs):
+    """
+    opens a zarr dataset stored on IPFS through the cache
+    """
+    import xarray as xr
+    return xr.open_dataset(get_mapper(url, **kwargs), engine="zarr")
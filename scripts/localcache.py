@@ -0,0 +1,147 @@
+# on-disk caches shared by the loaders and report scripts
+#
+# all caches live below a common base directory which defaults to
+# ~/.cache/flight_segmentation and can be moved by setting FLIGHTSEG_CACHE_DIR
+
+import os
+import hashlib
+import contextlib
+
+__all__ = ["CacheMiss", "cache_dir", "offline", "file_lock", "DiskLRU"]
+
+
+class CacheMiss(ConnectionError):
+    """
+    raised in offline mode if something is not in the cache
+
+    This is deliberately not a FileNotFoundError or LookupError, such that callers
+    (e.g. zarr) do not mistake an uncached object for a missing one.
+    """
+
+
+def cache_dir(name):
+    """
+    :param name: name of the sub-cache
+    :returns: path to the (created) cache directory
+    """
+    base = os.environ.get("FLIGHTSEG_CACHE_DIR") \
+        or os.path.join(os.path.expanduser("~"), ".cache", "flight_segmentation")
+    path = os.path.join(base, name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def offline():
+    """
+    True if network access should be avoided (FLIGHTSEG_OFFLINE is set).
+    """
+    return os.environ.get("FLIGHTSEG_OFFLINE", "").lower() not in ["", "0", "false", "no"]
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    exclusive lock across processes, held on the file `path` (created if missing)
+    """
+    import fcntl
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def parse_size(size):
+    """
+    parses sizes like 1000, "500M" or "20G" into bytes
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    units = {"K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+    size = size.strip().upper().rstrip("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+class DiskLRU:
+    """
+    Directory of immutable blobs addressed by a key, limited to `max_size` bytes.
+
+    Blobs are stored under the sha256 of their key. The modification time of a
+    blob is refreshed on every hit, so evicting the oldest files first yields
+    least recently used eviction, which also works if several processes share
+    the same directory.
+    """
+    def __init__(self, path, max_size="20G"):
+        self.path = path
+        self.max_size = parse_size(max_size)
+        os.makedirs(self.path, exist_ok=True)
+        self._size = None
+
+    def _blob_path(self, key):
+        h = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, h[:2], h)
+
+    def _files(self):
+        for entry in os.scandir(self.path):
+            if entry.is_dir():
+                for f in os.scandir(entry.path):
+                    if f.is_file() and not f.name.endswith(".tmp"):
+                        yield f
+
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = sum(f.stat().st_size for f in self._files())
+        return self._size
+
+    def __contains__(self, key):
+        return os.path.exists(self._blob_path(key))
+
+    def get(self, key):
+        """
+        :returns: the stored bytes or None if `key` is not in the cache
+        """
+        path = self._blob_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        path = self._blob_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        self._size = self.size + len(data)
+        if self._size > self.max_size:
+            self.evict()
+
+    def evict(self, target=None):
+        """
+        removes least recently used blobs until the cache is below `target`
+        bytes (90% of `max_size` by default)
+        """
+        if target is None:
+            target = int(self.max_size * .9)
+        files = sorted(((f.stat().st_mtime, f.stat().st_size, f.path) for f in self._files()))
+        size = sum(s for _, s, _ in files)
+        for _, s, path in files:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+                size -= s
+            except FileNotFoundError:
+                pass
+        self._size = size
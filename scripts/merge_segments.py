@@ -1,8 +1,14 @@
+import os
+import json
+import time
+import hashlib
+import warnings
 import yaml
 import fsspec
 import frontmatter
 from collections import defaultdict
 from utils import segment_hash
+from localcache import cache_dir, offline as offline_mode
 
 def normalize_atr_segment(segment, flight_id):
     return {
@@ -14,17 +20,84 @@ def normalize_atr_segment(segment, flight_id):
         "remarks": segment.get("note") or [],
     }
 
-def add_halo_nickname(flight_id):
-    url = f"https://raw.githubusercontent.com/orcestra-campaign/book/refs/heads/main/orcestra_book/reports/{flight_id}.md"
+# change to invalidate the normalized results stored in merge manifests
+NORMALIZE_VERSION = 1
+
+NICKNAME_URL = "https://raw.githubusercontent.com/orcestra-campaign/book/refs/heads/main/orcestra_book/reports/{flight_id}.md"
+
+def nickname_cache_file(url=NICKNAME_URL):
+    """
+    :returns: cache file of the nicknames fetched from the url template `url`,
+              such that e.g. test servers do not share the cache of the flight reports
+    """
+    if url == NICKNAME_URL:
+        name = "nicknames.json"
+    else:
+        name = f"nicknames-{hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]}.json"
+    return os.path.join(cache_dir("nicknames"), name)
+
+def fetch_halo_nicknames(flight_ids, url=NICKNAME_URL, max_age=24 * 3600, offline=None, cache_file=None):
+    """
+    Looks up the nicknames of many HALO flights from the front matter of their flight reports.
+
+    All reports which are not in the local cache or older than `max_age` seconds are
+    fetched concurrently through one HTTP session. If fetching fails, outdated cache
+    entries are used instead.
+
+    :param url: url template of the flight reports, e.g. pointing to a local HTTP server for tests
+    :param offline: only use the cache, defaults to $FLIGHTSEG_OFFLINE
+    :param cache_file: defaults to the cache of `url`, see `nickname_cache_file`
+    :returns: dict of flight id to nickname, None if there is no report for a flight
+    """
+    if offline is None:
+        offline = offline_mode()
+    if cache_file is None:
+        cache_file = nickname_cache_file(url)
     try:
-        with fsspec.open(url, "r") as f:
-            metadata = frontmatter.load(f)
-            ret = metadata["nickname"]
+        with open(cache_file) as f:
+            cache = json.load(f)
     except FileNotFoundError:
-        ret = None
-    return ret
+        cache = {}
+
+    now = time.time()
+    outdated = [flight_id for flight_id in dict.fromkeys(flight_ids)
+                if flight_id not in cache or now - cache[flight_id]["fetched"] > max_age]
+
+    if outdated and not offline:
+        urls = {url.format(flight_id=flight_id): flight_id for flight_id in outdated}
+        fs = fsspec.filesystem(url.split(":")[0])
+        for u, content in fs.cat(list(urls), on_error="return").items():
+            flight_id = urls[u]
+            if isinstance(content, FileNotFoundError):
+                nickname = None
+            elif isinstance(content, Exception):
+                if flight_id in cache:
+                    warnings.warn(f"could not fetch nickname of {flight_id}, using cached value: {content}")
+                    continue
+                raise content
+            else:
+                nickname = frontmatter.loads(content.decode("utf-8"))["nickname"]
+            cache[flight_id] = {"nickname": nickname, "fetched": now}
 
-def normalize_segmentation(meta):
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(cache_file + ".tmp", "w") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(cache_file + ".tmp", cache_file)
+
+    missing = [flight_id for flight_id in flight_ids if flight_id not in cache]
+    if missing:
+        raise LookupError(f"nicknames of {', '.join(missing)} are not cached and offline mode is enabled")
+
+    return {flight_id: cache[flight_id]["nickname"] for flight_id in flight_ids}
+
+def add_halo_nickname(flight_id):
+    return fetch_halo_nicknames([flight_id])[flight_id]
+
+def normalize_segmentation(meta, nicknames=None):
+    """
+    :param meta: segmentation of a flight as loaded from a flight segment file
+    :param nicknames: optional dict of nicknames of HALO flights, looked up if missing
+    """
     if meta["mission"]=="MAESTRO":
         meta["platform"] = "ATR"
         #meta["atr_flight_id"] = meta["flight_id"]
@@ -41,7 +114,10 @@ def normalize_segmentation(meta):
                             {"name": "Julia Windmiller", "email": "julia.windmiller@mpimet.mpg.de"},
                             ]
         meta["remarks"] = meta.get("remarks") or []
-        meta["name"] = add_halo_nickname(meta["flight_id"])
+        if nicknames is not None and meta["flight_id"] in nicknames:
+            meta["name"] = nicknames[meta["flight_id"]]
+        else:
+            meta["name"] = add_halo_nickname(meta["flight_id"])
 
     keys = ["mission", "platform", "flight_id", "name",
             "date", "takeoff", "landing",
@@ -52,27 +128,133 @@ def normalize_segmentation(meta):
 
     return ordered_dict
 
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def manifest_file_for(output):
+    """
+    :returns: manifest of incremental merges into `output`, next to it
+    """
+    return f"{output}.manifest.json"
+
+def load_manifest(manifest_file, output):
+    """
+    :returns: dict of input content hash to normalized segmentation, empty if there is no
+              manifest of the current NORMALIZE_VERSION or `output` is not the one it was written with
+    """
+    try:
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        output_hash = file_hash(output)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if manifest.get("version") != NORMALIZE_VERSION or manifest.get("output") != output_hash:
+        return {}
+    return {h: yaml.safe_load(meta) for h, meta in manifest["results"].items()}
+
+def save_manifest(manifest_file, results, output):
+    """
+    :param results: dict of input content hash to normalized segmentation
+    :param output: the merged file just written from `results`
+    """
+    import tempfile
+    # normalized segmentations are stored as yaml text, which keeps their timestamps as in the output
+    manifest = {"version": NORMALIZE_VERSION,
+                "output": file_hash(output),
+                "results": {h: yaml.safe_dump(meta, sort_keys=False) for h, meta in results.items()}}
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(manifest_file)), suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp, manifest_file)
+
+def merge_segmentations(files, previous=None, **nickname_args):
+    """
+    Loads and normalizes many flight segment files.
+
+    :param files: flight segment files, in output order
+    :param previous: normalized segmentations of a previous merge by input content hash, see
+                     `load_manifest`. Only files whose content is not in there are loaded and
+                     normalized again, as well as HALO flights whose nickname changed.
+    :param nickname_args: passed on to `fetch_halo_nicknames`
+    :returns: dict of platform to dict of flight id to normalized segmentation, and dict of
+              input content hash to normalized segmentation of exactly the given files
+    """
+    previous = previous or {}
+    hashes = {file: file_hash(file) for file in files}
+
+    metas = {}
+    for file in files:
+        if hashes[file] not in previous:
+            with open(file) as f:
+                metas[file] = yaml.safe_load(f)
+
+    def is_halo(file):
+        if file in metas:
+            return metas[file].get("platform") == "HALO"
+        return previous[hashes[file]]["platform"] == "HALO"
+
+    def flight_id(file):
+        return metas[file]["flight_id"] if file in metas else previous[hashes[file]]["flight_id"]
+
+    nicknames = fetch_halo_nicknames([flight_id(file) for file in files if is_halo(file)], **nickname_args)
+
+    results = {}
+    all_flights = defaultdict(dict)
+    for file in files:
+        if file in metas:
+            meta = normalize_segmentation(metas[file], nicknames)
+        else:
+            meta = previous[hashes[file]]
+            if meta["platform"] == "HALO" and meta["name"] != nicknames[meta["flight_id"]]:
+                with open(file) as f:
+                    meta = normalize_segmentation(yaml.safe_load(f), nicknames)
+        results[hashes[file]] = meta
+        all_flights[meta["platform"]][meta["flight_id"]] = meta
+
+    return {**all_flights}, results
+
 def __main__():
     import argparse
     parser = argparse.ArgumentParser(description="Merge flight segment files")
     parser.add_argument("-i", "--input", type=str, nargs="+", help="input files")
     parser.add_argument("-o", "--output", type=str, help="output file")
+    parser.add_argument("--offline", action="store_true", default=None, help="only use cached HALO nicknames")
+    parser.add_argument("--nickname-url", default=NICKNAME_URL, help="url template of HALO flight reports")
+    parser.add_argument("--nickname-max-age", type=float, default=24, help="hours until cached HALO nicknames are fetched again")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only normalize inputs changed since the last merge into OUTPUT, tracked in OUTPUT.manifest.json")
+    parser.add_argument("--stats", action="store_true", help="add navdata statistics of all segments of flights with navdata to the segments table")
+    parser.add_argument("-s", "--sonde_info", default=None,
+                        help="sonde info yaml file or sonde table for sonde counts of --stats (default: local sonde table, if any)")
+    parser.add_argument("-j", "--jobs", type=int, default=8, help="number of flights processed concurrently by --stats")
     args = parser.parse_args()
 
-    all_flights = defaultdict(dict)
-
-    for file in args.input:
-        with open(file) as f:
-            meta = normalize_segmentation(yaml.safe_load(f))
-            flight_id = meta["flight_id"]
-            platform = meta["platform"]
-            all_flights[platform][flight_id] = meta
-    
-    all_flights = {**all_flights}
+    manifest_file = manifest_file_for(args.output)
+    previous = load_manifest(manifest_file, args.output) if args.incremental else None
+    all_flights, results = merge_segmentations(args.input, previous,
+                                               url=args.nickname_url,
+                                               max_age=args.nickname_max_age * 3600,
+                                               offline=args.offline)
 
     with open(args.output, "w") as f:
         yaml.dump(all_flights, f, sort_keys=False)
-            
+    if args.incremental:
+        # before statistics are attached to the segmentations
+        save_manifest(manifest_file, results, args.output)
+
+    # statistics only go into the companion tables, the schema of the yaml file stays the same
+    if args.stats:
+        from sondes import SondeIndex, load_sonde_info, default_table_file
+        from segmentstats import attach_stats
+        sonde_info = None
+        if args.sonde_info is not None or os.path.exists(default_table_file()):
+            sonde_info = SondeIndex(load_sonde_info(args.sonde_info))
+        attach_stats(all_flights, sonde_info, jobs=args.jobs)
+
+    from flighttables import write_tables
+    write_tables(all_flights, args.output)
+
 
 if __name__ == "__main__":
-    __main__()
\ No newline at end of file
+    __main__()
@@ -2,31 +2,118 @@
 # that way it is possible to run the code for one platform if dependencies
 # for another platform are not met
 
-_catalog_cache = {}
+#HALO_ROOT = "ipns://latest.orcestra-campaign.org/products/HALO/position_attitude"
+HALO_ROOT = "ipfs://QmTGwJ6VAn2FTiwsXaAA4BUA82RN2zQPBEJ8rpWrviW4c3"
 
-def get_navdata_HALO(flight, hres=False):
+# resolutions of the local navdata pyramid, "full" is the original data rate
+RESOLUTIONS = ["full", "1s", "10s", "60s"]
+
+def _pyramid_path_HALO(flight):
+    import os
+    from localcache import cache_dir
+    return os.path.join(cache_dir("navdata"), HALO_ROOT.split("/")[-1], f"{flight}.zarr")
+
+def build_pyramid_HALO(flight, path=None):
+    """
+    Stores the navdata of a flight at all coarse RESOLUTIONS with the mean, min
+    and max of every variable per bin (`<var>`, `<var>_min`, `<var>_max`) as
+    zarr groups named like the resolution. Coarser levels are aggregated from
+    the 1s level, weighted by the number of samples per bin.
+    """
+    import os
+    import shutil
+    import xarray as xr
+    from ipfscache import open_zarr
+
+    path = path or _pyramid_path_HALO(flight)
+    raw = open_zarr(f"{HALO_ROOT}/{flight}.zarr").reset_coords().load()
+    fine = raw.resample(time="1s")
+    mean, count = fine.mean(), fine.count()
+    vmin, vmax = fine.min(), fine.max()
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    for resolution in RESOLUTIONS[1:]:
+        if resolution != "1s":
+            coarse = lambda ds: ds.resample(time=resolution)
+            total = coarse(count).sum()
+            mean, vmin, vmax = (coarse(mean * count).sum() / total).where(total > 0), coarse(vmin).min(), coarse(vmax).max()
+            count = total
+        level = xr.merge([mean,
+                          vmin.rename({v: f"{v}_min" for v in vmin.data_vars}),
+                          vmax.rename({v: f"{v}_max" for v in vmax.data_vars})])
+        level.to_zarr(tmp, group=resolution, mode="w", consolidated=False)
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        # built concurrently by another process
+        shutil.rmtree(tmp, ignore_errors=True)
+    return path
+
+def get_navdata_HALO(flight, hres=False, resolution="1s", extrema=False):
     """
     :param flight: flight id
+    :param hres: same as resolution="full"
+    :param resolution: one of RESOLUTIONS, coarse resolutions are read from
+                       the local pyramid, which is built on first use
+    :param extrema: include `<var>_min` and `<var>_max` of each bin
     """
+    import os
     import xarray as xr
+    from ipfscache import open_zarr
+
+    if hres or resolution == "full":
+        return open_zarr(f"{HALO_ROOT}/{flight}.zarr").reset_coords()
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"unknown navdata resolution {resolution}, choose from {RESOLUTIONS}")
 
-    #root = "ipns://latest.orcestra-campaign.org/products/HALO/position_attitude"
-    root = "ipfs://QmTGwJ6VAn2FTiwsXaAA4BUA82RN2zQPBEJ8rpWrviW4c3"
-    if hres:
-        ds = xr.open_dataset(f"{root}/{flight}.zarr", engine="zarr").reset_coords()
-    else:
-        ds = xr.open_dataset(f"{root}/{flight}.zarr", engine="zarr").reset_coords().resample(time="1s").mean()
+    path = _pyramid_path_HALO(flight)
+    if not os.path.exists(path):
+        build_pyramid_HALO(flight, path)
+    ds = xr.open_dataset(path, group=resolution, engine="zarr", consolidated=False)
+    if not extrema:
+        ds = ds[[v for v in ds.data_vars if not v.endswith(("_min", "_max"))]]
     return ds
 
+def navdata_source_HALO(flight, hres=False, resolution="1s"):
+    """
+    identifies the data returned by `get_navdata_HALO`
+    """
+    if hres or resolution == "full":
+        return f"{HALO_ROOT}/{flight}.zarr"
+    return f"{HALO_ROOT}/{flight}.zarr#resample={resolution}"
+
+def segmented_flights_HALO():
+    """
+    :returns: ids of all HALO flights with a segmentation notebook
+    """
+    import os
+    import glob
+    basedir = os.path.abspath(os.path.dirname(__file__))
+    return sorted(os.path.basename(f)[len("segmentation_"):-len(".md")]
+                  for f in glob.glob(os.path.join(basedir, "segmentation_HALO-*.md")))
+
 NAVDATA_GETTERS = {
     "HALO": get_navdata_HALO,
 }
 
-def get_navdata(platform, flight):
+NAVDATA_SOURCES = {
+    "HALO": navdata_source_HALO,
+}
+
+def get_navdata(platform, flight, **kwargs):
+    """
+    :param platform: platform id
+    :param flight: flight id
+    :param kwargs: passed to the platform loader, e.g. `resolution`
+    """
+    return NAVDATA_GETTERS[platform](flight, **kwargs)
+
+def get_navdata_source(platform, flight, **kwargs):
     """
     :param platform: platform id
     :param flight: flight id
+    :returns: string identifying the content of `get_navdata(platform, flight, **kwargs)`
     """
-    return NAVDATA_GETTERS[platform](flight)
+    return NAVDATA_SOURCES[platform](flight, **kwargs)
 
-__all__ = ["get_navdata"]
+__all__ = ["get_navdata", "get_navdata_source"]
@@ -0,0 +1,126 @@
+# constant time statistics of navdata over arbitrary time ranges
+#
+# Cumulative sums (and sums of squares) and sparse tables of minima and maxima
+# are built once per flight, afterwards mean, standard deviation, range and the
+# circular spread of the heading of any segment are O(1).
+
+import numpy as np
+
+__all__ = ["PrefixStats"]
+
+VARIABLES = ["roll", "pitch", "alt"]
+
+
+def _prefix(x):
+    return np.concatenate([[0.], np.cumsum(x)])
+
+
+class _SparseTable:
+    """minimum and maximum of any index range in O(1), NaN are ignored"""
+    def __init__(self, values):
+        self.min = [np.where(np.isnan(values), np.inf, values)]
+        self.max = [np.where(np.isnan(values), -np.inf, values)]
+        width = 1
+        while 2 * width <= len(values):
+            self.min.append(np.minimum(self.min[-1][:-width], self.min[-1][width:]))
+            self.max.append(np.maximum(self.max[-1][:-width], self.max[-1][width:]))
+            width *= 2
+
+    def query(self, i0, i1):
+        k = int(i1 - i0).bit_length() - 1
+        return (min(self.min[k][i0], self.min[k][i1 - 2**k]),
+                max(self.max[k][i0], self.max[k][i1 - 2**k]))
+
+
+class PrefixStats:
+    """
+    Statistics of the navdata of one flight over time ranges.
+
+    All methods take index ranges [i0, i1) as returned by `indices`, and return NaN
+    for ranges without valid values.
+    """
+    def __init__(self, ds, variables=VARIABLES):
+        """
+        :param ds: navdata of the flight
+        :param variables: variables of which sums and extrema are kept, if present
+        """
+        self.time = ds["time"].values.astype("datetime64[ns]")
+        self.variables = [v for v in variables if v in ds]
+        self._count, self._sum, self._sum2, self._extrema, self._offset = {}, {}, {}, {}, {}
+        for v in self.variables:
+            x = ds[v].values.astype(float)
+            valid = np.isfinite(x)
+            # sums of deviations from the flight mean limit the cancellation in variances
+            self._offset[v] = x[valid].mean() if valid.any() else 0.
+            x0 = np.where(valid, x - self._offset[v], 0.)
+            self._count[v] = _prefix(valid)
+            self._sum[v] = _prefix(x0)
+            self._sum2[v] = _prefix(x0 ** 2)
+            self._extrema[v] = _SparseTable(x)
+        self.has_heading = "heading" in ds
+        if self.has_heading:
+            h = np.radians(ds["heading"].values.astype(float))
+            valid = np.isfinite(h)
+            self._count["heading"] = _prefix(valid)
+            self._sin = _prefix(np.where(valid, np.sin(h), 0.))
+            self._cos = _prefix(np.where(valid, np.cos(h), 0.))
+        dt = np.diff(self.time)
+        self.dt = np.median(dt) if len(dt) else np.timedelta64(1, "s")
+
+    def indices(self, start, end):
+        """
+        :returns: index range [i0, i1) of the samples in the semi-open segment [start, end)
+        """
+        return (int(np.searchsorted(self.time, np.datetime64(start, "ns"), "left")),
+                int(np.searchsorted(self.time, np.datetime64(end, "ns"), "left")))
+
+    def count(self, v, i0, i1):
+        """number of valid samples"""
+        return self._count[v][i1] - self._count[v][i0]
+
+    def mean(self, v, i0, i1):
+        n = self.count(v, i0, i1)
+        return (self._sum[v][i1] - self._sum[v][i0]) / n + self._offset[v] if n else np.nan
+
+    def std(self, v, i0, i1):
+        n = self.count(v, i0, i1)
+        if not n:
+            return np.nan
+        m = (self._sum[v][i1] - self._sum[v][i0]) / n
+        return np.sqrt(max((self._sum2[v][i1] - self._sum2[v][i0]) / n - m ** 2, 0.))
+
+    def min_max(self, v, i0, i1):
+        if not self.count(v, i0, i1):
+            return np.nan, np.nan
+        return self._extrema[v].query(i0, i1)
+
+    def max_deviation(self, v, i0, i1):
+        """largest absolute deviation from the mean"""
+        lo, hi = self.min_max(v, i0, i1)
+        m = self.mean(v, i0, i1)
+        return max(hi - m, m - lo)
+
+    def range(self, v, i0, i1):
+        lo, hi = self.min_max(v, i0, i1)
+        return hi - lo
+
+    def heading_mean(self, i0, i1):
+        """circular mean of the heading in degrees"""
+        return np.degrees(np.arctan2(self._sin[i1] - self._sin[i0], self._cos[i1] - self._cos[i0])) % 360
+
+    def heading_std(self, i0, i1):
+        """circular standard deviation of the heading in degrees"""
+        n = self.count("heading", i0, i1)
+        if not n:
+            return np.nan
+        r = np.hypot(self._sin[i1] - self._sin[i0], self._cos[i1] - self._cos[i0]) / n
+        return np.degrees(np.sqrt(-2 * np.log(min(max(r, 1e-12), 1.))))
+
+    def missing_fraction(self, v, start, end):
+        """
+        fraction of samples missing in [start, end), either as time gaps or as NaN,
+        assuming the median sampling interval of the flight
+        """
+        i0, i1 = self.indices(start, end)
+        expected = max(int(np.ceil((np.datetime64(end, "ns") - np.datetime64(start, "ns")) / self.dt)), 1)
+        return max(1. - self.count(v, i0, i1) / expected, 0.)
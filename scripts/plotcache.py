@@ -0,0 +1,130 @@
+# cache of rendered segment plots
+#
+# Plots are stored by a fingerprint of everything they show: the plot function
+# (and its PLOT_VERSION), the navdata of the segment and its border windows
+# (including their times, hence segment start, end and border_time) and the
+# sonde positions by flag. Cache hits skip matplotlib completely.
+#
+# hit and miss statistics are kept next to the cache:
+#
+#     python3 plotcache.py [--reset]
+
+import os
+import json
+import hashlib
+import numpy as np
+
+from localcache import cache_dir, file_lock, DiskLRU
+
+__all__ = ["PlotCache", "fingerprint"]
+
+
+def _update(h, obj):
+    import xarray as xr
+    if isinstance(obj, xr.Dataset):
+        h.update(b"dataset")
+        for name in sorted(obj.variables):
+            h.update(str(name).encode("utf-8"))
+            h.update(np.ascontiguousarray(obj[name].values).tobytes())
+    elif isinstance(obj, dict):
+        h.update(b"dict")
+        for k in sorted(obj):
+            _update(h, k)
+            _update(h, obj[k])
+    elif isinstance(obj, (list, tuple)):
+        h.update(b"list")
+        for v in obj:
+            _update(h, v)
+    else:
+        h.update(repr(obj).encode("utf-8"))
+
+
+def fingerprint(*objs):
+    """
+    :returns: sha256 over datasets, dicts, lists and plain values
+    """
+    h = hashlib.sha256()
+    for obj in objs:
+        _update(h, obj)
+    return h.hexdigest()
+
+
+def plot_id(plot):
+    """
+    identifies a plot function, including the parameters of plots built by closures like `zoom_on`
+    """
+    cells = [c.cell_contents for c in (plot.__closure__ or [])]
+    return f"{plot.__module__}.{plot.__qualname__}{cells!r}"
+
+
+class PlotCache:
+    """
+    DiskLRU of PNG data with persistent hit and miss counters.
+    """
+    def __init__(self, path=None, max_size="2G"):
+        self.path = path or cache_dir("plots")
+        self.blobs = DiskLRU(self.path, max_size)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        png = self.blobs.get(key)
+        if png is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return png
+
+    def put(self, key, png):
+        self.blobs.put(key, png)
+
+    @property
+    def stats_file(self):
+        return os.path.join(self.path, "stats.json")
+
+    def stats(self):
+        """
+        :returns: dict of accumulated hits and misses
+        """
+        try:
+            with open(self.stats_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"hits": 0, "misses": 0}
+
+    def save_stats(self):
+        """
+        adds the hits and misses counted since the last call to the stored statistics,
+        under a lock such that concurrent report workers do not lose counts
+        """
+        with file_lock(self.stats_file + ".lock"):
+            stats = self.stats()
+            stats["hits"] += self.hits
+            stats["misses"] += self.misses
+            tmp = f"{self.stats_file}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(stats, f)
+            os.replace(tmp, self.stats_file)
+        self.hits = self.misses = 0
+
+
+def _main():
+    import argparse
+    parser = argparse.ArgumentParser(description="show statistics of the segment plot cache")
+    parser.add_argument("--reset", action="store_true", help="reset hit and miss counters")
+    args = parser.parse_args()
+
+    cache = PlotCache()
+    if args.reset:
+        with file_lock(cache.stats_file + ".lock"):
+            if os.path.exists(cache.stats_file):
+                os.remove(cache.stats_file)
+    stats = cache.stats()
+    total = stats["hits"] + stats["misses"]
+    print(f"{cache.path}: {cache.blobs.size / 2**20:.1f} MiB of {cache.blobs.max_size / 2**20:.0f} MiB")
+    print(f"hits: {stats['hits']}, misses: {stats['misses']}"
+          + (f", hit rate: {stats['hits'] / total:.1%}" if total else ""))
+
+
+if __name__ == "__main__":
+    _main()
@@ -1,4 +1,5 @@
 import os
+import hashlib
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 import yaml
 import xarray as xr
@@ -10,6 +11,7 @@ from base64 import b64encode
 
 from navdata import get_navdata
 from checkers import FlightChecker, kinds_is_circle
+from sondes import SondeIndex, load_sonde_info
 
 border_time = np.timedelta64(3, "m")
 
@@ -30,13 +32,44 @@ env = Environment(
     autoescape=select_autoescape(['html', 'xml'])
 )
 
-def fig2data_url(fig):
+def fig2png(fig):
     io = BytesIO()
     fig.savefig(io, format="PNG", bbox_inches="tight")
-    b64 = b64encode(io.getvalue())
+    return io.getvalue()
+
+def png2data_url(png):
+    b64 = b64encode(png)
     url = "data:{};base64,{}".format("image/png", b64.decode("ascii"))
     return url
 
+def fig2data_url(fig):
+    return png2data_url(fig2png(fig))
+
+def write_asset(png, asset_dir):
+    """
+    writes a PNG into `asset_dir`, named by its content hash, such that
+    unchanged images are shared between reports and builds
+
+    :returns: path of the image file
+    """
+    name = hashlib.sha256(png).hexdigest()[:32] + ".png"
+    path = os.path.join(asset_dir, name)
+    if not os.path.exists(path):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(png)
+        os.replace(tmp, path)
+    return path
+
+def image_url(png, outfile, asset_dir=None):
+    """
+    :returns: data url of the PNG, or the url of its asset file relative to `outfile` if `asset_dir` is given
+    """
+    if asset_dir is None:
+        return png2data_url(png)
+    path = write_asset(png, asset_dir)
+    return os.path.relpath(path, os.path.dirname(os.path.abspath(outfile))).replace(os.sep, "/")
+
 def start_end_lims(navdata):
     lat_min = min(*navdata.lat.data[[0,-1]])
     lat_max = max(*navdata.lat.data[[0,-1]])
@@ -173,6 +206,9 @@ def timeline_of(var, unit):
         return fig
     return plot
 
+# change when plot functions change, to invalidate cached plots
+PLOT_VERSION = 1
+
 SPECIAL_PLOTS = {
     "circle": [circle_detail_plot, zoom_on("roll", "deg")],
     "circling": [zoom_on("roll", "deg", tofs=np.timedelta64(3, "m")),
@@ -192,57 +228,107 @@ def plots_for_kinds(kinds):
             for plot in SPECIAL_PLOTS.get(kind, [])]
 
 
-def sonde_info_from_yaml(filehandle):
-    return yaml.load(filehandle, Loader=yaml.SafeLoader)
+def render_segment_plot(kinds, index, seg, sonde_tracks_by_flag, seg_before, seg_after):
+    """
+    renders the `index`-th plot of `plots_for_kinds(kinds)`
 
-def sonde_info_from_ipfs(flight_id):
-    import pandas as pd
-    from utils import get_sondes_l2
+    :returns: tuple of PNG data and warning, one of them is None
+    """
+    plot = plots_for_kinds(kinds)[index]
     try:
-        ds = get_sondes_l2(flight_id)
-        return [ {
-        "launch_time": pd.Timestamp(str(ds.isel({"sonde_id": i}).launch_time.values)).to_pydatetime(warn=False),
-        "platform": "HALO",
-        "sonde_id": str(ds.isel({"sonde_id": i}).sonde_id.values),
-        "flag": "ALL_FLAGS",
-        } for i in range(ds.sizes["sonde_id"])]
-    except FileNotFoundError:
-        print(f"No dropsondes on flight {flight_id}")
-        return []
+        return fig2png(plot(seg, sonde_tracks_by_flag, seg_before, seg_after)), None
+    except Exception as e:
+        return None, "plot could not be created: {}".format(e)
+    finally:
+        plt.close("all")
+
+def _render_segment_plot(task):
+    return render_segment_plot(*task)
+
+def _render_uncached_segment_plots(tasks, jobs=1):
+    if jobs > 1 and len(tasks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(jobs) as pool:
+            return list(pool.map(_render_segment_plot, tasks))
+    return [_render_segment_plot(task) for task in tasks]
+
+def plot_key(kinds, index, seg, sonde_tracks_by_flag, seg_before, seg_after):
+    """
+    identifies the result of `render_segment_plot`
+    """
+    from plotcache import fingerprint, plot_id
+    return fingerprint(f"plot version {PLOT_VERSION}",
+                       plot_id(plots_for_kinds(kinds)[index]),
+                       seg, seg_before, seg_after,
+                       sonde_tracks_by_flag)
+
+def render_segment_plots(tasks, jobs=1, cache=None):
+    """
+    renders all plot tasks (arguments to `render_segment_plot`), using a pool
+    of `jobs` processes if `jobs` > 1. Results are returned in task order.
+
+    :param cache: optional PlotCache, only plots which are not cached are rendered
+    """
+    if cache is None:
+        return _render_uncached_segment_plots(tasks, jobs)
+
+    keys = [plot_key(*task) for task in tasks]
+    results = [(png, None) if (png := cache.get(key)) is not None else None for key in keys]
+    missing = [i for i, r in enumerate(results) if r is None]
+    for i, result in zip(missing, _render_uncached_segment_plots([tasks[i] for i in missing], jobs)):
+        if result[0] is not None:
+            cache.put(keys[i], result[0])
+        results[i] = result
+    cache.save_stats()
+    return results
 
-def _main():
-    basedir = os.path.abspath(os.path.dirname(__file__))
-    import argparse
-    parser = argparse.ArgumentParser()
-    parser.add_argument("infile")
-    parser.add_argument("outfile")
-    parser.add_argument("-s", "--sonde_info", help="sonde info yaml file", default=None)
-    args = parser.parse_args()
 
-    flightdata = yaml.load(open(args.infile), Loader=yaml.SafeLoader)
+def sonde_info_from_yaml(filehandle):
+    return yaml.load(filehandle, Loader=yaml.SafeLoader)
 
-    checker = FlightChecker(flightdata)
-    global_warnings = list(checker.check_flight(flightdata))
+def sonde_info_from_ipfs(flight_id):
+    from sondes import update_sonde_table
+    sonde_info = update_sonde_table([flight_id]).sonde_info(flight_id.split("-")[0], flight_id)
+    if len(sonde_info) == 0:
+        print(f"No dropsondes on flight {flight_id}")
+    return sonde_info
+
+def build_report(flightdata, outfile, sonde_info=None, jobs=1, asset_dir=None, plot_cache=None):
+    """
+    renders the report of one flight
+
+    :param flightdata: segmentation of the flight as loaded from the segment file
+    :param outfile: output html filename
+    :param sonde_info: list of sonde infos, looked up from IPFS if None
+    :param jobs: number of processes for rendering segment plots
+    :param asset_dir: directory for content-hashed plot images referenced by the report,
+                      plots are embedded as data urls (single file report) if None
+    :param plot_cache: optional PlotCache of rendered segment plots
+    """
+    global_warnings = list(FlightChecker(flightdata).check_flight(flightdata))
 
     flight_id = flightdata.get("flight_id", "")
     platform = flightdata.get("platform", "")
 
-    if args.sonde_info is None:
+    if sonde_info is None:
         sonde_info = sonde_info_from_ipfs(flight_id)
-    else:
-        sonde_info = sonde_info_from_yaml(open(args.sonde_info))
-    
+
     navdata = get_navdata(platform, flight_id).load()
+    # reports only show warnings, including those of not yet validated thresholds
+    checker = FlightChecker(flightdata, navdata, uncalibrated=True)
 
-    sonde_info = [s for s in sonde_info if s["platform"] == platform]
-    sondes_by_id = {s["sonde_id"]: s for s in sonde_info}
+    sondes = SondeIndex(sonde_info).for_flight(platform, flight_id).attach_positions(navdata)
+    sondes_by_id = {s["sonde_id"]: s for s in sondes.sondes}
 
+    overview = get_navdata(platform, flight_id, resolution="10s")
     fig, ax = plt.subplots()
-    ax.plot(navdata.lon, navdata.lat)
-    im = fig2data_url(fig)
+    ax.plot(overview.lon, overview.lat)
+    if asset_dir is not None:
+        os.makedirs(asset_dir, exist_ok=True)
+    flightdata["plot_data"] = image_url(fig2png(fig), outfile, asset_dir)
     plt.close("all")
-    flightdata["plot_data"] = im
 
+    plot_tasks = []
     for seg in flightdata["segments"]:
         t_start = np.datetime64(seg["start"])
         t_end = np.datetime64(seg["end"])
@@ -250,37 +336,23 @@ def _main():
         seg_before = navdata.sel(time=slice(t_start - border_time, t_start))
         seg_after = navdata.sel(time=slice(t_end, t_end + border_time))
 
-        sondes_in_segment = [s
-                             for s in sonde_info
-                             if s["launch_time"] >= seg["start"]
-                             and s["launch_time"] < seg["end"]]
-        sondes_by_flag = {f: [s for s in sondes_in_segment if s["flag"] == f]
-                          for f in set(s["flag"] for s in sondes_in_segment)}
+        sondes_by_flag = sondes.by_flag(seg["start"], seg["end"])
 
         manual_sondes_by_flag = {f: [sondes_by_id[s] for s in sondes] for f, sondes in seg.get("dropsondes", {}).items()}
 
         seg["sondes_by_flag"] = sondes_by_flag
 
-        sonde_times = [s["launch_time"] for s in sondes_in_segment]
+        sonde_times = [s["launch_time"] for s in sondes.in_segment(seg["start"], seg["end"])]
 
-        sonde_tracks_by_flag = {
-            f: navdata.sel(time=[s["launch_time"] for s in sondes], method="nearest")
-            for f, sondes in sondes_by_flag.items()
-            #for f, sondes in manual_sondes_by_flag.items()
-        }
+        sonde_tracks_by_flag = sondes.tracks_by_flag(seg["start"], seg["end"])
 
-        plot_data = []
         warnings = list(checker.check_segment(seg, seg_navdata, sondes_by_flag))
 
-        for plot in plots_for_kinds(seg.get("kinds", [])):
-            try:
-                plot_data.append(fig2data_url(
-                    plot(seg_navdata, sonde_tracks_by_flag, seg_before, seg_after)))
-                plt.close("all")
-            except Exception as e:
-                warnings.append("plot could not be created: {}".format(e))
+        kinds = seg.get("kinds", [])
+        plot_tasks += [(seg, (kinds, i, seg_navdata, sonde_tracks_by_flag, seg_before, seg_after))
+                       for i in range(len(plots_for_kinds(kinds)))]
 
-        seg["plot_data"] = plot_data
+        seg["plot_data"] = []
         if len(sonde_times) > 0:
             seg["time_to_first_sonde"] = (np.datetime64(sonde_times[0]) - t_start) / np.timedelta64(1, "s")
         if kinds_is_circle(seg.get("kinds", [])):
@@ -288,12 +360,45 @@ def _main():
 
         seg["warnings"] = warnings
 
+    plots = render_segment_plots([task for _, task in plot_tasks], jobs=jobs, cache=plot_cache)
+    for (seg, _), (png, warning) in zip(plot_tasks, plots):
+        if png is not None:
+            seg["plot_data"].append(image_url(png, outfile, asset_dir))
+        else:
+            seg["warnings"].append(warning)
+
     flightdata["warnings"] = global_warnings
 
     tpl = env.get_template("flight.html")
 
-    with open(args.outfile, "w") as outfile:
-        outfile.write(tpl.render(flight=flightdata))
+    with open(outfile, "w") as f:
+        tpl.stream(flight=flightdata).dump(f)
+
+def _main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("infile")
+    parser.add_argument("outfile")
+    parser.add_argument("-s", "--sonde_info", help="sonde info yaml file or sonde table", default=None)
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of processes for rendering segment plots")
+    parser.add_argument("-a", "--assets", default=None, help="write plots as image files into this directory instead of embedding them")
+    parser.add_argument("--no-plot-cache", action="store_true", help="render all plots, without using or storing cached plots")
+    args = parser.parse_args()
+
+    flightdata = yaml.load(open(args.infile), Loader=yaml.SafeLoader)
+
+    if args.sonde_info is None:
+        sonde_info = None
+    else:
+        sonde_info = load_sonde_info(args.sonde_info)
+
+    if args.no_plot_cache:
+        plot_cache = None
+    else:
+        from plotcache import PlotCache
+        plot_cache = PlotCache()
+
+    build_report(flightdata, args.outfile, sonde_info, jobs=args.jobs, asset_dir=args.assets, plot_cache=plot_cache)
 
 if __name__ == "__main__":
     _main()
@@ -0,0 +1,204 @@
+# runs segmentation notebooks headless to (re)generate flight segment files
+#
+# The Makefile executes notebooks with `jupytext --execute`, this runner is an
+# opt-in alternative (`make segment_files`), and `make check_segment_files` fails
+# unless it writes the same files. Instead of executing the whole notebook in a
+# kernel, only the statements needed to compute the arguments of the notebook's
+# `yaml.dump(to_yaml(...), ...)` call are executed in-process. Plotting and other
+# statements whose results are not used by `to_yaml` are skipped. The resulting
+# YAML is written with the same `yaml.dump(..., sort_keys=False)` as the notebook.
+#
+# If the reduced notebook fails with a NameError (e.g. a needed variable is only
+# defined as a side effect), the notebook is run again with all statements.
+#
+#     python3 run_segmentation.py [-o OUTDIR] [-j JOBS] scripts/segmentation_HALO-*.md
+
+import ast
+import os
+import sys
+import contextlib
+
+# modules which are only needed for plotting
+PLOT_MODULES = ["matplotlib", "hvplot", "bokeh", "panel"]
+
+
+def _is_to_yaml_call(node):
+    return (isinstance(node, ast.Call)
+            and (getattr(node.func, "id", None) == "to_yaml" or getattr(node.func, "attr", None) == "to_yaml"))
+
+
+def _is_plot_import(stmt):
+    if isinstance(stmt, ast.Import):
+        names = [a.name for a in stmt.names]
+    elif isinstance(stmt, ast.ImportFrom):
+        names = [stmt.module or ""]
+    else:
+        return False
+    return all(n.split(".")[0] in PLOT_MODULES for n in names)
+
+
+def _loads(node):
+    return {n.id for n in ast.walk(node) if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Load)}
+
+
+def _defines(stmt):
+    """
+    names bound or modified by a statement, including `x[...] = ...`,
+    `x.attr = ...` and method call statements like `x.append(...)`
+    """
+    names = set()
+    if isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        names.add(stmt.name)
+    for n in ast.walk(stmt):
+        if isinstance(n, ast.Name) and isinstance(n.ctx, (ast.Store, ast.Del)):
+            names.add(n.id)
+        elif isinstance(n, (ast.Subscript, ast.Attribute)) and isinstance(n.ctx, (ast.Store, ast.Del)):
+            base = n.value
+            while isinstance(base, (ast.Subscript, ast.Attribute)):
+                base = base.value
+            if isinstance(base, ast.Name):
+                names.add(base.id)
+    if isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Call) \
+            and isinstance(stmt.value.func, ast.Attribute) and isinstance(stmt.value.func.value, ast.Name):
+        names.add(stmt.value.func.value.id)
+    return names
+
+
+def notebook_statements(path):
+    """
+    :returns: top-level statements of all code cells of a notebook
+    """
+    import jupytext
+    nb = jupytext.read(path)
+    return [stmt
+            for cell in nb.cells if cell.cell_type == "code"
+            for stmt in ast.parse(cell.source, filename=path).body]
+
+
+def reduce_notebook(statements):
+    """
+    :returns: the statements needed to compute the `to_yaml(...)` call, and that call
+    :raises ValueError: if the notebook does not call `to_yaml`
+    """
+    for i, stmt in enumerate(statements):
+        calls = [n for n in ast.walk(stmt) if _is_to_yaml_call(n)]
+        if calls:
+            break
+    else:
+        raise ValueError("notebook does not call to_yaml")
+
+    needed = _loads(calls[0])
+    keep = []
+    for stmt in reversed(statements[:i]):
+        if isinstance(stmt, (ast.Import, ast.ImportFrom)):
+            if not _is_plot_import(stmt):
+                keep.append(stmt)
+        elif _defines(stmt) & needed:
+            keep.append(stmt)
+            needed |= _loads(stmt)
+    return keep[::-1], calls[0], statements[:i]
+
+
+_navdata_cache = {}
+
+def _shared_get_navdata_HALO(get_navdata_HALO):
+    def get_navdata(flight, **kwargs):
+        key = (flight, tuple(sorted(kwargs.items())))
+        if key not in _navdata_cache:
+            _navdata_cache[key] = get_navdata_HALO(flight, **kwargs)
+        return _navdata_cache[key].copy()
+    return get_navdata
+
+
+def _execute(statements, call, path):
+    namespace = {"__name__": "__main__", "__file__": path}
+    exec(compile(ast.Module(body=statements, type_ignores=[]), path, "exec"), namespace)
+    return eval(compile(ast.Expression(body=call), path, "eval"), namespace)
+
+
+def run_notebook(path, outdir, all_statements=False):
+    """
+    computes the segmentation of a notebook and writes it to `outdir/<flight_id>.yaml`
+
+    :param all_statements: execute all statements before the `to_yaml` call, not only the needed ones
+    :returns: the written filename
+    """
+    import yaml
+    import matplotlib
+    matplotlib.use("Agg")
+    import navdata
+    if not hasattr(navdata.get_navdata_HALO, "__wrapped__"):
+        shared = _shared_get_navdata_HALO(navdata.get_navdata_HALO)
+        shared.__wrapped__ = navdata.get_navdata_HALO
+        navdata.get_navdata_HALO = navdata.NAVDATA_GETTERS["HALO"] = shared
+
+    path = os.path.abspath(path)
+    outdir = os.path.abspath(outdir)
+    reduced, call, statements = reduce_notebook(notebook_statements(path))
+
+    # notebooks are executed in their own directory, like jupytext does
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(path))
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            if all_statements:
+                data = _execute(statements, call, path)
+            else:
+                try:
+                    data = _execute(reduced, call, path)
+                except NameError:
+                    data = _execute(statements, call, path)
+    finally:
+        os.chdir(cwd)
+
+    outfile = os.path.join(outdir, f"{data['flight_id']}.yaml")
+    with open(outfile, "w") as f:
+        yaml.dump(data, f, sort_keys=False)
+    return outfile
+
+
+def _run_notebook(task):
+    path, outdir, all_statements = task
+    try:
+        return path, run_notebook(path, outdir, all_statements), None
+    except Exception as e:
+        return path, None, f"{type(e).__name__}: {e}"
+
+
+def run_notebooks(paths, outdir, jobs=1, all_statements=False):
+    """
+    runs many notebooks, `jobs` of them in parallel processes
+
+    :returns: list of (notebook, written filename or None, error or None)
+    """
+    tasks = [(path, outdir, all_statements) for path in paths]
+    if jobs > 1 and len(tasks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(jobs) as pool:
+            return list(pool.map(_run_notebook, tasks))
+    return [_run_notebook(task) for task in tasks]
+
+
+def _main():
+    import argparse
+    parser = argparse.ArgumentParser(description="generate flight segment files from segmentation notebooks")
+    parser.add_argument("notebooks", nargs="+", help="segmentation notebooks (jupytext markdown)")
+    parser.add_argument("-o", "--outdir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "flight_segment_files"),
+                        help="output directory")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of notebooks run in parallel")
+    parser.add_argument("--all", action="store_true", help="execute all statements before to_yaml, not only the needed ones")
+    args = parser.parse_args()
+
+    os.makedirs(args.outdir, exist_ok=True)
+    failed = 0
+    for path, outfile, error in run_notebooks(args.notebooks, args.outdir, args.jobs, args.all):
+        if error is None:
+            print(outfile)
+        else:
+            failed += 1
+            print(f"{path}: {error}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    exit(_main())
@@ -0,0 +1,153 @@
+# persistent cache of satellite track forecasts
+#
+# Forecasts are identified by (satellite, issue_date, kind, roi, valid_date) and
+# never change once issued, so every track is downloaded from the sattracks server
+# only once. Issue dates without a forecast are remembered as well, such that
+# later lookups neither retry them nor download anything.
+#
+# The cache of all HALO flight days can be filled in advance:
+#
+#     python3 sattracks.py [-d DATE ...]
+
+import io
+import warnings
+import numpy as np
+
+from localcache import CacheMiss, cache_dir, offline, DiskLRU
+
+__all__ = ["load_track", "ec_roi", "ec_track_for_day"]
+
+MISSING = b"\0missing"
+# number of days a forecast may be issued before the valid date
+MAX_LEAD_DAYS = 6
+
+
+def _cache():
+    return DiskLRU(cache_dir("sattracks"), "1G")
+
+
+def _key(satellite, issue_date, kind, roi, valid_date):
+    return f"{satellite}/{np.datetime64(issue_date, 'D')}/{kind}/{roi}/{np.datetime64(valid_date, 'D')}"
+
+
+def load_track(satellite, issue_date, valid_date, kind="PRE", roi="CAPE_VERDE", cache=None):
+    """
+    :returns: forecasted satellite track of `valid_date`, issued on `issue_date`
+    :raises LookupError: if no such forecast has been issued or it could not be loaded
+    :raises CacheMiss: if it is not cached in offline mode
+    """
+    import pandas as pd
+    cache = cache or _cache()
+    key = _key(satellite, issue_date, kind, roi, valid_date)
+
+    data = cache.get(key)
+    if data == MISSING:
+        raise LookupError(f"no forecast for {key}")
+    if data is not None:
+        return pd.read_parquet(io.BytesIO(data)).to_xarray()
+    if offline():
+        raise CacheMiss(f"forecast {key} is not cached and FLIGHTSEG_OFFLINE is set")
+
+    import orcestra.sat
+    try:
+        track = orcestra.sat.SattrackLoader(satellite, issue_date, kind=kind, roi=roi) \
+                            .get_track_for_day(valid_date)
+    except KeyError:
+        # the forecast index has no such entry. Forecasts are issued daily, an issue
+        # date which has passed without one stays missing
+        if np.datetime64(issue_date, "D") < np.datetime64("today", "D"):
+            cache.put(key, MISSING)
+        raise LookupError(f"no forecast for {key}")
+    except Exception as e:
+        # any other failure (network, server, file format) falls back to an older
+        # forecast as well, but is not remembered
+        raise LookupError(f"forecast {key} could not be loaded: {e!r}") from e
+
+    buf = io.BytesIO()
+    track.to_dataframe().to_parquet(buf)
+    cache.put(key, buf.getvalue())
+    return track
+
+
+def ec_roi(valid_date):
+    """
+    :returns: sattracks region of interest of the HALO base on `valid_date`
+    """
+    if np.datetime64(valid_date) > np.datetime64("2024-11-01T00:00:00"):
+        return "EUR"
+    elif np.datetime64(valid_date) >= np.datetime64("2024-09-07T00:00:00"):
+        return "BARBADOS"
+    else:
+        return "CAPE_VERDE"
+
+
+def ec_track_for_day(valid_date, cache=None):
+    """
+    :returns: the most recent EarthCARE track forecast of `valid_date`
+    :raises LookupError: if there is no forecast issued up to MAX_LEAD_DAYS before
+    :raises CacheMiss: if a forecast is not cached in offline mode, instead of falling back to an older one
+    """
+    valid_date = np.datetime64(valid_date, "D")
+    roi = ec_roi(valid_date)
+    errors = []
+    for i in range(MAX_LEAD_DAYS):
+        issue_date = valid_date - np.timedelta64(i, "D")
+        try:
+            track = load_track("EARTHCARE", issue_date, valid_date, kind="PRE", roi=roi, cache=cache)
+        except LookupError as e:
+            errors.append(str(e))
+            continue
+        if i > 0:
+            warnings.warn(f"No sattrack forecast issued on flightday ({errors[0]}), " +
+                          f"using the sattrack forecast issued on {issue_date}!")
+        return track
+    raise LookupError(f"no EarthCARE track forecast for {valid_date}")
+
+
+def campaign_dates():
+    """
+    :returns: flight days of all HALO segmentation notebooks
+    """
+    from utils import flight_id2datestr
+    from navdata import segmented_flights_HALO
+    return sorted(set(flight_id2datestr(f) for f in segmented_flights_HALO()))
+
+
+def prewarm(dates, jobs=8):
+    """
+    fills the cache with the EarthCARE tracks of `dates`
+
+    :returns: dict of date to the error message of dates without track
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    cache = _cache()
+
+    def load(date):
+        try:
+            ec_track_for_day(date, cache=cache)
+        except Exception as e:
+            return date, str(e)
+
+    with ThreadPoolExecutor(jobs) as pool:
+        return dict(r for r in pool.map(load, dates) if r is not None)
+
+
+def _main():
+    import argparse
+    parser = argparse.ArgumentParser(description="fill the satellite track cache")
+    parser.add_argument("-d", "--dates", nargs="+", default=None, help="flight days (default: all HALO flight days)")
+    parser.add_argument("-j", "--jobs", type=int, default=8, help="number of concurrent downloads")
+    args = parser.parse_args()
+
+    dates = args.dates or campaign_dates()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        failed = prewarm(dates, args.jobs)
+    for date, message in failed.items():
+        print(f"{date}: {message}")
+    print(f"cached EarthCARE tracks of {len(dates) - len(failed)} of {len(dates)} days")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    exit(_main())
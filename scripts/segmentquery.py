@@ -0,0 +1,218 @@
+# time queries over all segments and events of the compiled segment file
+#
+# Segments are semi-open intervals [start, end) as defined in the README, such
+# that consecutive segments do not share their boundary. Events are points.
+# Segments and events of all platforms are put into centered interval trees,
+# one per kind and platform filter, answering point and window queries in
+# O(log n + k). Arrays of timestamps, e.g. all
+# samples of an instrument time series, are tagged at once:
+#
+#     index = SegmentIndex.from_segmentfile("all_flights.yaml")
+#     index.at("2024-08-13T12:00", kinds="circle")
+#     index.tag(ds.time.values, platforms="HALO")
+#
+#     python3 segmentquery.py [-s all_flights.yaml] [-k KIND] [-p PLATFORM] TIME [END]
+
+import numpy as np
+
+__all__ = ["SegmentIndex"]
+
+ITEM_COLUMNS = ["type", "platform", "flight_id", "id", "name", "kinds", "start", "end"]
+
+
+def _ns(t):
+    return np.asarray(t, dtype="datetime64[ns]").astype("int64")
+
+
+class _Node:
+    __slots__ = ["center", "starts", "by_start", "ends", "by_end", "left", "right"]
+
+
+class IntervalTree:
+    """
+    Static centered interval tree over half-open intervals [start, end).
+
+    Each node keeps the intervals containing its center, sorted by start and by end,
+    intervals entirely left or right of the center are passed on to the children.
+    """
+    def __init__(self, start, end):
+        self.start = np.asarray(start, dtype="int64")
+        self.end = np.asarray(end, dtype="int64")
+        self.root = self._build(np.arange(len(self.start)))
+
+    def _build(self, idx):
+        if len(idx) == 0:
+            return None
+        start, end = self.start[idx], self.end[idx]
+        node = _Node()
+        # lower median of the endpoints, exact in int64, never passes all intervals to one child
+        points = np.concatenate([start, end])
+        node.center = np.partition(points, (len(points) - 1) // 2)[(len(points) - 1) // 2]
+        here = (start <= node.center) & (end > node.center)
+        by_start = idx[here][np.argsort(start[here], kind="stable")]
+        by_end = idx[here][np.argsort(end[here], kind="stable")]
+        node.by_start, node.starts = by_start, self.start[by_start]
+        node.by_end, node.ends = by_end, self.end[by_end]
+        node.left = self._build(idx[end <= node.center])
+        node.right = self._build(idx[start > node.center])
+        return node
+
+    def overlapping(self, a, b):
+        """
+        :returns: indices of all intervals overlapping the closed window [a, b], in ascending order
+        """
+        found = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            if b < node.center:
+                found.append(node.by_start[:np.searchsorted(node.starts, b, "right")])
+                stack.append(node.left)
+            elif a >= node.center:
+                found.append(node.by_end[np.searchsorted(node.ends, a, "right"):])
+                stack.append(node.right)
+            else:
+                found.append(node.by_start)
+                stack.append(node.left)
+                stack.append(node.right)
+        return np.sort(np.concatenate(found)) if found else np.array([], dtype=int)
+
+
+def _as_filter(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return (value,)
+    return tuple(sorted(value))
+
+
+class SegmentIndex:
+    """
+    Time index over the segments and events of many flights.
+
+    Query results are DataFrames with the columns `ITEM_COLUMNS`, where `type`
+    is "segment" or "event", `id` the segment_id or event_id and `kinds` a list.
+    """
+    def __init__(self, tables):
+        """
+        :param tables: companion tables of the compiled segment file, see flighttables.py
+        """
+        import pandas as pd
+        keys = ["platform", "flight_id", "position"]
+
+        def items(df, kind, id_column, start, end):
+            kinds = df.groupby(keys, sort=False)["kind"].agg(lambda k: [v for v in k if pd.notna(v)])
+            df = df.drop_duplicates(keys).set_index(keys)
+            return pd.DataFrame({"type": kind,
+                                 "id": df[id_column],
+                                 "name": df["name"],
+                                 "kinds": kinds,
+                                 "start": df[start],
+                                 "end": df[end]}).reset_index()
+
+        self.items = pd.concat([items(tables["segments"], "segment", "segment_id", "start", "end"),
+                                items(tables["events"], "event", "event_id", "time", "time")],
+                               ignore_index=True)[ITEM_COLUMNS]
+        self.start = _ns(self.items["start"].values)
+        # exclusive ends, events cover exactly their time
+        self.end = _ns(self.items["end"].values) + (self.items["type"].values == "event")
+        self._item_kinds = [set(k) for k in self.items["kinds"]]
+        self._item_platforms = self.items["platform"].values
+        self._trees = {}
+
+    @classmethod
+    def from_segmentfile(cls, segmentfile):
+        """
+        :param segmentfile: compiled segment file (all_flights.yaml), its companion tables are used if up to date
+        """
+        import flighttables
+        if flighttables.has_tables(segmentfile):
+            return cls(flighttables.load_tables(segmentfile))
+        import yaml
+        with open(segmentfile) as f:
+            return cls(flighttables.tables_from_meta(yaml.safe_load(f)))
+
+    def _selection(self, kinds, platforms):
+        """indices of the items having any of `kinds` on any of `platforms`"""
+        # segments ending at (or before) their start cover no time
+        selected = self.end > self.start
+        if kinds is not None:
+            selected &= np.array([not k.isdisjoint(kinds) for k in self._item_kinds], dtype=bool)
+        if platforms is not None:
+            selected &= np.isin(self._item_platforms, platforms)
+        return np.flatnonzero(selected)
+
+    def _tree(self, kinds, platforms):
+        key = (_as_filter(kinds), _as_filter(platforms))
+        if key not in self._trees:
+            idx = self._selection(*key)
+            self._trees[key] = IntervalTree(self.start[idx], self.end[idx]), idx
+        return self._trees[key]
+
+    def overlapping(self, start, end, kinds=None, platforms=None):
+        """
+        :param kinds: only segments and events having any of these kinds
+        :param platforms: only segments and events of these platforms
+        :returns: segments and events overlapping the window [start, end], i.e. segments
+                  starting before or at `end` and ending after `start`
+        """
+        tree, idx = self._tree(kinds, platforms)
+        return self.items.iloc[idx[tree.overlapping(_ns(start), _ns(end))]]
+
+    def at(self, time, kinds=None, platforms=None):
+        """
+        :returns: segments covering `time` (start <= time < end) and events at exactly `time`
+        """
+        return self.overlapping(time, time, kinds, platforms)
+
+    def pairs(self, times, kinds=None, platforms=None):
+        """
+        :param times: array of timestamps
+        :returns: arrays of time indices and item indices (rows of `items`) of all matches
+        """
+        idx = self._selection(_as_filter(kinds), _as_filter(platforms))
+        times = _ns(np.atleast_1d(times))
+        order = np.argsort(times, kind="stable")
+        sorted_times = times[order]
+        i0 = np.searchsorted(sorted_times, self.start[idx], "left")
+        i1 = np.searchsorted(sorted_times, self.end[idx], "left")
+        counts = np.maximum(i1 - i0, 0)
+        item = np.repeat(idx, counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        sample = order[np.repeat(i0, counts) + offsets]
+        o = np.lexsort((item, sample))
+        return sample[o], item[o]
+
+    def tag(self, times, kinds=None, platforms=None, column="id"):
+        """
+        :param times: array of timestamps, e.g. of an instrument time series
+        :returns: list with the `column` values (default: ids) of all segments and events at each time
+        """
+        sample, item = self.pairs(times, kinds, platforms)
+        values = self.items[column].to_numpy(dtype=object)[item].tolist()
+        bounds = np.searchsorted(sample, np.arange(len(np.atleast_1d(times)) + 1)).tolist()
+        return [values[i0:i1] for i0, i1 in zip(bounds[:-1], bounds[1:])]
+
+
+def _main():
+    import argparse
+    import pandas as pd
+    parser = argparse.ArgumentParser(description="find segments and events at a time or in a time window")
+    parser.add_argument("time", help="time or start of the window")
+    parser.add_argument("end", nargs="?", default=None, help="end of the window")
+    parser.add_argument("-s", "--segmentfile", default="all_flights.yaml", help="compiled segment file")
+    parser.add_argument("-k", "--kind", dest="kinds", action="append", help="only segments and events of this kind (repeatable)")
+    parser.add_argument("-p", "--platform", dest="platforms", action="append", help="only segments and events of this platform (repeatable)")
+    args = parser.parse_args()
+
+    index = SegmentIndex.from_segmentfile(args.segmentfile)
+    found = index.overlapping(np.datetime64(args.time), np.datetime64(args.end or args.time),
+                              kinds=args.kinds, platforms=args.platforms)
+    with pd.option_context("display.max_rows", None, "display.width", None):
+        print(found.to_string(index=False))
+
+
+if __name__ == "__main__":
+    _main()
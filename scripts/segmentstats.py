@@ -0,0 +1,120 @@
+# summary statistics of all segments of the compiled segment file
+#
+# For every flight with navdata, the statistics of all its segments are computed
+# from one pass over the navdata (cumulative sums, see navstats.py). They are
+# attached as `stats` of each segment and end up in the segments table (see
+# flighttables.py), not in all_flights.yaml:
+#
+#     duration      s
+#     distance      along-track distance, m
+#     alt_mean      WGS84 altitude, m
+#     alt_min
+#     alt_max
+#     heading_mean  circular mean, deg
+#     roll_std      deg
+#     sonde_count   sondes launched in the segment
+#     radius_std    circles only: standard deviation of the distance to the fitted center, m
+#
+# Results are cached by segment times, circle fits, navdata source and sondes.
+
+import json
+import hashlib
+import numpy as np
+
+from localcache import cache_dir, DiskLRU
+
+__all__ = ["segment_stats", "attach_stats", "STATS"]
+
+STATS = ["duration", "distance", "alt_mean", "alt_min", "alt_max", "heading_mean",
+         "roll_std", "sonde_count", "radius_std"]
+
+# change to invalidate cached statistics
+STATS_VERSION = 2
+
+
+def _round(value, digits):
+    return None if not np.isfinite(value) else round(float(value), digits)
+
+
+def along_track_distance(ds):
+    """
+    :returns: cumulative geodesic distance along the track in m, steps from or to invalid positions count as 0
+    """
+    from orcestra.flightplan import geod
+    lat, lon = ds["lat"].values.astype(float), ds["lon"].values.astype(float)
+    _, _, d = geod.inv(lon[:-1], lat[:-1], lon[1:], lat[1:])
+    return np.concatenate([[0.], np.cumsum(np.nan_to_num(d))])
+
+
+def segment_stats(segments, ds, sondes=None):
+    """
+    :param segments: segments of a flight as in a flight segment file
+    :param ds: navdata of the flight
+    :param sondes: optional FlightSondes of the flight
+    :returns: list of dicts of STATS per segment
+    """
+    from navstats import PrefixStats
+    from orcestra.flightplan import geod
+    stats = PrefixStats(ds)
+    distance = along_track_distance(ds)
+
+    result = []
+    for seg in segments:
+        i0, i1 = stats.indices(seg["start"], seg["end"])
+        duration = (np.datetime64(seg["end"], "ns") - np.datetime64(seg["start"], "ns")) / np.timedelta64(1, "s")
+        alt_min, alt_max = stats.min_max("alt", i0, i1) if i1 > i0 else (np.nan, np.nan)
+        s = {"duration": _round(duration, 0),
+             "distance": _round(distance[i1 - 1] - distance[i0], 0) if i1 > i0 else None,
+             "alt_mean": _round(stats.mean("alt", i0, i1), 1),
+             "alt_min": _round(alt_min, 1),
+             "alt_max": _round(alt_max, 1),
+             "heading_mean": _round(stats.heading_mean(i0, i1), 1) if stats.count("heading", i0, i1) else None,
+             "roll_std": _round(stats.std("roll", i0, i1), 2),
+             "sonde_count": len(sondes.in_segment(seg["start"], seg["end"])) if sondes is not None else None}
+        if "radius" in seg and i1 > i0:
+            lat, lon = ds["lat"].values[i0:i1], ds["lon"].values[i0:i1]
+            _, _, d = geod.inv(lon, lat, np.full_like(lon, seg["clon"]), np.full_like(lat, seg["clat"]))
+            s["radius_std"] = _round(np.nanstd(d), 1)
+        result.append(s)
+    return result
+
+
+def _key(flight, navdata_source, sondes):
+    h = hashlib.sha256()
+    h.update(json.dumps([[str(s["start"]), str(s["end"]), s.get("clat"), s.get("clon"), s.get("radius")]
+                         for s in flight["segments"]]).encode("utf-8"))
+    if sondes is not None:
+        h.update(sondes.launch_times.tobytes())
+    return f"{flight['platform']}/{flight['flight_id']}/{navdata_source}/{h.hexdigest()}/stats version {STATS_VERSION}"
+
+
+def attach_stats(all_flights, sonde_info=None, jobs=8, cache=None):
+    """
+    adds `stats` to all segments of all flights with navdata
+
+    :param all_flights: dict of platform to dict of flight id to normalized segmentation
+    :param sonde_info: optional SondeIndex for sonde counts
+    :param jobs: number of flights processed concurrently
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from navdata import get_navdata, get_navdata_source, NAVDATA_GETTERS
+    cache = cache or DiskLRU(cache_dir("segstats"), "100M")
+
+    def attach(flight):
+        sondes = sonde_info.for_flight(flight["platform"], flight["flight_id"]) if sonde_info is not None else None
+        key = _key(flight, get_navdata_source(flight["platform"], flight["flight_id"]), sondes)
+        data = cache.get(key)
+        if data is None:
+            ds = get_navdata(flight["platform"], flight["flight_id"])[["lat", "lon", "alt", "heading", "roll"]].load()
+            stats = segment_stats(flight["segments"], ds, sondes)
+            cache.put(key, json.dumps(stats).encode("utf-8"))
+        else:
+            stats = json.loads(data)
+        for seg, s in zip(flight["segments"], stats):
+            seg["stats"] = s
+
+    flights = [flight for platform, platform_flights in all_flights.items() if platform in NAVDATA_GETTERS
+               for flight in platform_flights.values()]
+    with ThreadPoolExecutor(jobs) as pool:
+        list(pool.map(attach, flights))
+    return all_flights
@@ -0,0 +1,304 @@
+# index of dropsonde launches for assigning sondes to segments
+#
+# sonde infos are dicts with at least "launch_time", "platform", "sonde_id" and
+# "flag", optionally "flight_id", as loaded from sondes.yaml or from the
+# campaign-wide sonde table.
+#
+# The sonde table is a parquet file listing the metadata of all Level_2
+# dropsondes, built from their .zattrs once and updated incrementally:
+#
+#     python3 sondes.py [-f FLIGHT_ID ...] [-y sondes.yaml]
+
+import os
+import numpy as np
+
+__all__ = ["SondeIndex", "FlightSondes", "SondeTable", "update_sonde_table", "load_sonde_info"]
+
+SONDES_ROOT = "ipfs://QmVX8jNDXSFYXju3BmiemvaUYs3VDF1iMCcKyPLQYe3FuG"
+COLUMNS = ["platform", "flight_id", "launch_time", "sonde_id", "flag", "path"]
+
+
+class FlightSondes:
+    """
+    Sondes of one flight, sorted by launch time.
+
+    Sondes of a segment are found by binary search on the launch times and the
+    nearest navdata position of every sonde is computed only once per flight.
+    """
+    def __init__(self, sondes):
+        self.sondes = sorted(sondes, key=lambda s: s["launch_time"])
+        self.launch_times = np.array([np.datetime64(s["launch_time"], "ns") for s in self.sondes],
+                                     dtype="datetime64[ns]")
+        self.positions = None
+
+    def __len__(self):
+        return len(self.sondes)
+
+    def _range(self, start, end):
+        return (np.searchsorted(self.launch_times, np.datetime64(start, "ns"), "left"),
+                np.searchsorted(self.launch_times, np.datetime64(end, "ns"), "left"))
+
+    def in_segment(self, start, end):
+        """
+        :returns: sondes launched in [start, end) in order of launch
+        """
+        i0, i1 = self._range(start, end)
+        return self.sondes[i0:i1]
+
+    def by_flag(self, start, end):
+        """
+        :returns: dict of flag to sondes launched in [start, end), flags in order of first launch
+        """
+        sondes_by_flag = {}
+        for s in self.in_segment(start, end):
+            sondes_by_flag.setdefault(s["flag"], []).append(s)
+        return sondes_by_flag
+
+    def attach_positions(self, navdata):
+        """
+        looks up the nearest navdata position of all sondes at once
+        """
+        self.positions = navdata.sel(time=self.launch_times, method="nearest")
+        return self
+
+    def tracks_by_flag(self, start, end):
+        """
+        :returns: dict of flag to navdata at the launch positions of the sondes launched in [start, end)
+        """
+        i0, i1 = self._range(start, end)
+        flags = np.array([s["flag"] for s in self.sondes[i0:i1]], dtype=object)
+        return {f: self.positions.isel(time=i0 + np.where(flags == f)[0])
+                for f in dict.fromkeys(flags)}
+
+
+class SondeIndex:
+    """
+    Sonde infos partitioned by platform and flight.
+
+    Sondes without a "flight_id" are available for all flights of their platform.
+    """
+    def __init__(self, sonde_info):
+        self.partitions = {}
+        for s in sonde_info:
+            self.partitions.setdefault((s["platform"], s.get("flight_id")), []).append(s)
+
+    def for_flight(self, platform, flight_id=None):
+        """
+        :returns: FlightSondes of the given flight
+        """
+        sondes = self.partitions.get((platform, None), [])
+        if flight_id is not None:
+            sondes = sondes + self.partitions.get((platform, flight_id), [])
+        return FlightSondes(sondes)
+
+
+def default_table_file():
+    from localcache import cache_dir
+    return os.path.join(cache_dir("sondes"), "sondes.parquet")
+
+
+class SondeTable:
+    """
+    Metadata of all sondes, sorted by platform, flight and launch time.
+
+    Flights are located by binary search on the sorted (platform, flight_id) keys,
+    launch time ranges within a flight by binary search on the launch times.
+    Sondes with unknown flight have an empty flight_id.
+    """
+    def __init__(self, df=None):
+        import pandas as pd
+        if df is None:
+            df = pd.DataFrame({c: pd.Series(dtype="datetime64[ns]" if c == "launch_time" else object)
+                               for c in COLUMNS})
+        self.df = df[COLUMNS].sort_values(["platform", "flight_id", "launch_time"], kind="stable") \
+                             .reset_index(drop=True)
+        self._keys = (self.df["platform"] + "/" + self.df["flight_id"]).to_numpy(dtype=str)
+        self._times = self.df["launch_time"].to_numpy(dtype="datetime64[ns]")
+
+    @classmethod
+    def load(cls, path=None):
+        import pandas as pd
+        try:
+            return cls(pd.read_parquet(path or default_table_file()))
+        except FileNotFoundError:
+            return cls()
+
+    def save(self, path=None):
+        import tempfile
+        path = path or default_table_file()
+        # unique temporary file, concurrent writers never clobber each other's partial output
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        os.close(fd)
+        try:
+            self.df.to_parquet(tmp, index=False)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def __len__(self):
+        return len(self.df)
+
+    def flights(self):
+        return set(self.df["flight_id"])
+
+    def query(self, platform, flight_id="", start=None, end=None):
+        """
+        :returns: DataFrame of the sondes of a flight launched in [start, end), sorted by launch time
+        """
+        key = f"{platform}/{flight_id}"
+        i0 = np.searchsorted(self._keys, key, "left")
+        i1 = np.searchsorted(self._keys, key, "right")
+        if start is not None:
+            i0 += np.searchsorted(self._times[i0:i1], np.datetime64(start, "ns"), "left")
+        if end is not None:
+            i1 = i0 + np.searchsorted(self._times[i0:i1], np.datetime64(end, "ns"), "left")
+        return self.df.iloc[i0:i1]
+
+    def sonde_info(self, platform=None, flight_id=None):
+        """
+        :returns: list of sonde infos of a flight, or all sondes if no flight is given
+        """
+        if platform is None:
+            df = self.df
+        else:
+            df = self.query(platform, flight_id or "")
+        return [{"launch_time": t.to_pydatetime(warn=False),
+                 "platform": platform,
+                 "sonde_id": sonde_id,
+                 "flag": flag,
+                 **({"flight_id": flight_id} if flight_id else {})}
+                for platform, flight_id, t, sonde_id, flag
+                in zip(df["platform"], df["flight_id"], df["launch_time"], df["sonde_id"], df["flag"])]
+
+    def merge(self, df):
+        """
+        adds sondes to the table, replacing existing entries of the same sonde in the same flight
+        """
+        import pandas as pd
+        df = pd.concat([self.df, df[COLUMNS]], ignore_index=True) \
+               .drop_duplicates(["platform", "flight_id", "sonde_id"], keep="last")
+        return SondeTable(df)
+
+
+def read_level2_flight(flight_id, known_paths=(), root=SONDES_ROOT):
+    """
+    reads the metadata of all Level_2 sondes of a flight which are not in `known_paths`
+
+    :raises FileNotFoundError: if there are no sondes for the flight
+    """
+    import json
+    import pandas as pd
+    from ipfscache import get_filesystem
+    day_folder = root + "/Level_2/" + flight_id
+    fs = get_filesystem()
+    paths = [fn.split("/")[-1] for fn in fs.ls(day_folder, detail=False)]
+    paths = [p for p in paths if p not in set(known_paths)]
+    zattrs = fs.get_mapper(day_folder).getitems([p + "/.zattrs" for p in paths]) if paths else {}
+    records = [{**json.loads(zattrs[p + "/.zattrs"]), "path": p} for p in paths]
+    df = pd.DataFrame.from_records(records, columns=["sonde_ID", "sonde_time", "path"])
+    launch_time = pd.to_datetime(df["sonde_time"])
+    if launch_time.dt.tz is not None:
+        launch_time = launch_time.dt.tz_convert("UTC").dt.tz_localize(None)
+    return pd.DataFrame({"platform": flight_id.split("-")[0],
+                         "flight_id": flight_id,
+                         "launch_time": launch_time.astype("datetime64[ns]"),
+                         "sonde_id": df["sonde_ID"].astype(str),
+                         "flag": "ALL_FLAGS",
+                         "path": df["path"]})
+
+
+def table_lock(path=None):
+    """
+    exclusive lock of the sonde table for read-merge-write updates across processes
+    """
+    from localcache import file_lock
+    return file_lock((path or default_table_file()) + ".lock")
+
+
+def update_sonde_table(flight_ids=None, path=None, root=SONDES_ROOT):
+    """
+    Adds sondes of new sonde folders to the sonde table.
+
+    :param flight_ids: flights to update, all flights in the Level_2 folder if None.
+                       Flights without sondes are skipped.
+    :returns: the updated SondeTable
+    """
+    with table_lock(path):
+        return _update_sonde_table(flight_ids, path, root)
+
+
+def _update_sonde_table(flight_ids, path, root):
+    table = SondeTable.load(path)
+    if flight_ids is None:
+        from ipfscache import get_filesystem
+        flight_ids = [fn.split("/")[-1] for fn in get_filesystem().ls(root + "/Level_2", detail=False)]
+
+    new = []
+    for flight_id in flight_ids:
+        known = table.query(flight_id.split("-")[0], flight_id)["path"]
+        try:
+            df = read_level2_flight(flight_id, known_paths=set(known), root=root)
+        except FileNotFoundError:
+            continue
+        if len(df) > 0:
+            new.append(df)
+
+    if new:
+        import pandas as pd
+        table = table.merge(pd.concat(new, ignore_index=True))
+        table.save(path)
+    return table
+
+
+def add_sonde_info(table, sonde_info):
+    """
+    :param sonde_info: list of (flagged) sonde infos, e.g. from a sondes.yaml
+    :returns: a table with the sonde infos added, sondes without flight_id are
+              assigned to the flight of the same sonde_id in the table
+    """
+    import pandas as pd
+    flights = dict(zip(table.df["sonde_id"], zip(table.df["flight_id"], table.df["path"])))
+    df = pd.DataFrame.from_records([{"platform": s["platform"],
+                                     "flight_id": s.get("flight_id") or flights.get(str(s["sonde_id"]), ("", None))[0],
+                                     "launch_time": s["launch_time"],
+                                     "sonde_id": str(s["sonde_id"]),
+                                     "flag": s["flag"],
+                                     "path": flights.get(str(s["sonde_id"]), ("", None))[1]}
+                                    for s in sonde_info], columns=COLUMNS)
+    df["launch_time"] = pd.to_datetime(df["launch_time"]).astype("datetime64[ns]")
+    return table.merge(df)
+
+
+def load_sonde_info(filename=None):
+    """
+    loads sonde infos from a sondes.yaml or a sonde table (parquet), the default sonde table if None
+    """
+    if filename is not None and filename.endswith((".yaml", ".yml")):
+        import yaml
+        with open(filename) as f:
+            return yaml.load(f, Loader=yaml.SafeLoader)
+    return SondeTable.load(filename).sonde_info()
+
+
+def _main():
+    import argparse
+    parser = argparse.ArgumentParser(description="update the campaign-wide sonde table")
+    parser.add_argument("-o", "--table", default=None, help="sonde table file, defaults to the local cache")
+    parser.add_argument("-f", "--flights", nargs="+", default=None, help="flights to update (default: all)")
+    parser.add_argument("-y", "--yaml", default=None, help="add (flagged) sondes from a sondes.yaml")
+    args = parser.parse_args()
+
+    with table_lock(args.table):
+        table = _update_sonde_table(args.flights, args.table, SONDES_ROOT)
+        if args.yaml is not None:
+            import yaml
+            with open(args.yaml) as f:
+                table = add_sonde_info(table, yaml.load(f, Loader=yaml.SafeLoader))
+            table.save(args.table)
+
+    print(f"{len(table)} sondes of {len(table.flights())} flights in {args.table or default_table_file()}")
+
+
+if __name__ == "__main__":
+    _main()
@@ -3,8 +3,11 @@
 __all__ = [
     "get_sondes_l2",
     "get_overpass_point",
+    "get_overpass_points",
+    "TrackIndex",
     "plot_overpass_point",
     "get_overpass_track",
+    "nelder_mead_overpass",
     "get_ec_track",
     "ec_event",
     "pace_event",
@@ -17,33 +20,124 @@ __all__ = [
     "parse_segment",
     "to_yaml",
     "ransac_fit_circle",
+    "propose_segments",
+    "navdata_change_points",
 ]
 
 def get_sondes_l2(flight_id):
-    import fsspec
-    import json
-    import pandas as pd
-    root = "ipfs://QmVX8jNDXSFYXju3BmiemvaUYs3VDF1iMCcKyPLQYe3FuG"
-    day_folder = root + "/Level_2/" + flight_id
-    protocol = day_folder.split(":")[0]
-    fs = fsspec.filesystem(protocol)
-    filenames = [fn.split("/")[-1] + "/.zattrs" for fn in fs.ls(day_folder, detail=False)]
-    m = fsspec.get_mapper(day_folder)
-    zattrs = [json.loads(v) for v in m.getitems(filenames).values()]
-    df = pd.DataFrame.from_records(zattrs)[["sonde_ID", "sonde_time"]]
-    df["sonde_time"] = pd.to_datetime(df["sonde_time"])
-    return df.sort_values("sonde_time").set_index("sonde_ID").to_xarray().rename({"sonde_ID": "sonde_id", "sonde_time": "launch_time"})
+    """
+    :returns: sonde ids and launch times of the Level_2 sondes of a flight, from the sonde table
+    :raises FileNotFoundError: if there are no sondes for the flight
+    """
+    from sondes import update_sonde_table
+    df = update_sonde_table([flight_id]).query(flight_id.split("-")[0], flight_id)
+    if len(df) == 0:
+        raise FileNotFoundError(f"no Level_2 sondes for {flight_id}")
+    return df.set_index("sonde_id")[["launch_time"]].to_xarray()
+
+class TrackIndex:
+    """
+    Spatial index over the positions of a track, answering nearest point queries
+    for many targets at once.
+
+    Positions are indexed by a KD-tree over unit-sphere ECEF coordinates. All
+    positions which may be nearest on the WGS84 ellipsoid (chord length within
+    `ellipsoid_tolerance` of the shortest one) are then ranked by their geodesic
+    distance.
+    """
+    # maximum relative deviation of chord lengths on the unit sphere from
+    # geodesic distances on the ellipsoid, used to select candidates
+    ellipsoid_tolerance = .01
+
+    def __init__(self, ds):
+        import numpy as np
+        self.time = ds.time.values
+        self.lat = ds.lat.values
+        self.lon = ds.lon.values
+        self.valid = np.where(np.isfinite(self.lat) & np.isfinite(self.lon))[0]
+        self._trees = {}
+
+    @staticmethod
+    def _unit_vectors(lat, lon):
+        import numpy as np
+        lat = np.radians(lat)
+        lon = np.radians(lon)
+        return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+    def _tree(self, i0, i1):
+        """KD-tree over the valid samples with index in [i0, i1) and their indices"""
+        import numpy as np
+        from scipy.spatial import cKDTree
+        if (i0, i1) not in self._trees:
+            idx = self.valid[np.searchsorted(self.valid, i0):np.searchsorted(self.valid, i1)]
+            self._trees[(i0, i1)] = cKDTree(self._unit_vectors(self.lat[idx], self.lon[idx])), idx
+        return self._trees[(i0, i1)]
+
+    def nearest(self, target_lat, target_lon, seg=None):
+        """
+        :param target_lat: latitude(s) of the targets
+        :param target_lon: longitude(s) of the targets
+        :param seg: optionally restrict the track to a segment (anything `parse_segment` accepts)
+        :returns: geodesic distance [m] and time of the nearest track position per target
+        """
+        import numpy as np
+        from orcestra.flightplan import geod
+
+        target_lat, target_lon = np.broadcast_arrays(np.atleast_1d(target_lat).astype(float),
+                                                     np.atleast_1d(target_lon).astype(float))
+        if seg is None:
+            i0, i1 = 0, len(self.time)
+        else:
+            s = parse_segment(seg)["slice"]
+            i0 = 0 if s.start is None else np.searchsorted(self.time, np.datetime64(s.start), "left")
+            i1 = len(self.time) if s.stop is None else np.searchsorted(self.time, np.datetime64(s.stop), "right")
+        tree, idx = self._tree(i0, i1)
+
+        targets = self._unit_vectors(target_lat, target_lon)
+        chord, _ = tree.query(targets)
+        dist = np.empty(len(targets))
+        nearest = np.empty(len(targets), dtype=int)
+        for i, candidates in enumerate(tree.query_ball_point(targets, chord * (1 + self.ellipsoid_tolerance) + 1e-12)):
+            candidates = idx[candidates]
+            _, _, d = geod.inv(self.lon[candidates], self.lat[candidates],
+                               np.full(len(candidates), target_lon[i]),
+                               np.full(len(candidates), target_lat[i]))
+            dist[i] = np.min(d)
+            nearest[i] = candidates[np.argmin(d)]
+        return dist, self.time[nearest]
+
+
+_track_indices = {}
+
+def track_index(ds):
+    """
+    :returns: the TrackIndex of `ds`, which is only built once per dataset
+    """
+    import weakref
+    ref, index = _track_indices.get(id(ds), (None, None))
+    if ref is None or ref() is not ds:
+        index = TrackIndex(ds)
+        _track_indices[id(ds)] = weakref.ref(ds, lambda _, key=id(ds): _track_indices.pop(key, None)), index
+    return index
 
 def get_overpass_point(ds, target_lat, target_lon):
-    import numpy as np
-    from orcestra.flightplan import geod
-    _, _, dist = geod.inv(ds.lon.values,
-                          ds.lat.values,
-                          np.full_like(ds.lon.values, target_lon),
-                          np.full_like(ds.lon.values, target_lat),
-                         )
-    i = np.argmin(dist)
-    return float(dist[i]), ds.time.values[i]
+    dist, time = track_index(ds).nearest(target_lat, target_lon)
+    return float(dist[0]), time[0]
+
+def get_overpass_points(ds, targets, seg=None):
+    """
+    Nearest time and distance of a track to many point targets.
+
+    :param targets: list of target names (see `overpass_targets`) or (lat, lon) tuples
+    :param seg: optionally restrict the track to a segment
+    :returns: list of (distance, time) per target
+    """
+    if any(isinstance(t, str) for t in targets):
+        named = overpass_targets()
+        targets = [named[t][:2] if isinstance(t, str) else t for t in targets]
+    lat, lon = zip(*targets)
+    dist, time = track_index(ds).nearest(lat, lon, seg=seg)
+    return [(float(d), t) for d, t in zip(dist, time)]
     
 def plot_overpass_point(ds, target_lat, target_lon):
     import matplotlib.pyplot as plt
@@ -56,78 +150,184 @@ def plot_overpass_point(ds, target_lat, target_lon):
     print(f"{d:.0f}m @ {t}")
     plt.show()
 
+def ecef(lat, lon, alt=0.):
+    """
+    Earth-centered, earth-fixed cartesian coordinates [m] of WGS84 positions.
+
+    :returns: array of shape (..., 3)
+    """
+    import numpy as np
+    a = 6378137.
+    f = 1 / 298.257223563
+    e2 = f * (2 - f)
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    n = a / np.sqrt(1 - e2 * np.sin(lat)**2)
+    return np.stack([(n + alt) * np.cos(lat) * np.cos(lon),
+                     (n + alt) * np.cos(lat) * np.sin(lon),
+                     (n * (1 - e2) + alt) * np.sin(lat)], axis=-1)
+
+def closest_approach(a_time, a_lat, a_lon, b_time, b_lat, b_lon):
+    """
+    Exact time and distance of closest approach of two tracks given as plain arrays.
+
+    Both tracks are interpolated linearly onto the union of their sample times
+    within the common time range. On every interval between these times, the
+    separation vector of the tracks in ECEF coordinates is linear in time, so its
+    minimum length is found in closed form for all intervals at once.
+    The returned distance is the geodesic distance at the time of closest approach.
+
+    :returns: (distance [m], time), None if the tracks have no valid positions at common times
+    """
+    import numpy as np
+    from orcestra.flightplan import geod
+
+    a_time = np.asarray(a_time, dtype="datetime64[ns]")
+    b_time = np.asarray(b_time, dtype="datetime64[ns]")
+    t_start = max(a_time[0], b_time[0])
+    t_end = min(a_time[-1], b_time[-1])
+    knots = np.union1d(a_time[(a_time >= t_start) & (a_time <= t_end)],
+                       b_time[(b_time >= t_start) & (b_time <= t_end)])
+    if len(knots) == 0:
+        return None
+
+    def seconds(t):
+        return (t - knots[0]) / np.timedelta64(1, "s")
+
+    def position(t, time, lat, lon):
+        return np.interp(t, seconds(time), lat), np.interp(t, seconds(time), lon)
+
+    t = seconds(knots)
+    a = ecef(*position(t, a_time, a_lat, a_lon))
+    b = ecef(*position(t, b_time, b_lat, b_lon))
+    r = (b - a)[:-1]
+    dr = np.diff(b - a, axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tau = np.clip(-np.sum(r * dr, axis=-1) / np.sum(dr * dr, axis=-1), 0, 1)
+    tau = np.nan_to_num(tau, nan=0.)
+    d2 = np.sum((r + tau[:, np.newaxis] * dr)**2, axis=-1)
+
+    if len(d2) == 0:
+        t_min = t[0]
+    elif np.isnan(d2).all():
+        return None
+    else:
+        i = np.nanargmin(d2)
+        t_min = t[i] + tau[i] * (t[i + 1] - t[i])
+
+    a_lat_min, a_lon_min = position(t_min, a_time, a_lat, a_lon)
+    b_lat_min, b_lon_min = position(t_min, b_time, b_lat, b_lon)
+    _, _, dist = geod.inv(b_lon_min, b_lat_min, a_lon_min, a_lat_min)
+    return float(dist), knots[0] + np.round(t_min * 1e9).astype("timedelta64[ns]")
+
 def get_overpass_track(a_track, b_track, a_lon="lon", a_lat="lat", b_lon="lon", b_lat="lat", optimize=True):
     """
     Extract time and distance of closest point between two tracks given as datasets to the function.
     Optionally, the lat and lon coordinate names of the respective datasets can be specified
     if they are different from the default "lat" and "lon".
+
+    With `optimize`, the tracks are taken to be linear between their samples and the
+    closest approach is solved exactly (see `closest_approach`), otherwise the closest
+    sample of `a_track` is returned.
+
+    :returns: (distance [m], time), None if there is no closest approach (optimize only)
     """
+    if optimize:
+        return closest_approach(a_track.time.values, a_track[a_lat].values, a_track[a_lon].values,
+                                b_track.time.values, b_track[b_lat].values, b_track[b_lon].values)
+
     from orcestra.flightplan import geod
     a = a_track.sel(time=slice(*b_track.time[[0, -1]]))
     b = b_track.interp(time=a.time)
     _, _, dist = geod.inv(b[b_lon], b[b_lat], a[a_lon], a[a_lat])
     i = dist.argmin()
+    return float(dist[i]), a.time.values[i]
 
-    if optimize:
-        import numpy as np
-        from scipy.optimize import minimize
 
-        t_guess = a.time.values[i]
-        t_unit = np.timedelta64(1000_000_000, "ns")
+def flight_id2datestr(flight_id):
+    d = flight_id.split("-")[1][:-1]
+    return d[:4] + "-" + d[4:6] + "-" + d[6:]
+
+
+def get_ec_track(flight_id, ds):
+    """
+    :returns: EarthCARE track forecast during the flight, from the local sattracks cache
+    """
+    from sattracks import ec_track_for_day
+    from flightphases import flight_phases
+    phases = flight_phases(flight_id, ds)
+    takeoff, landing = phases["takeoff"], phases["landing"]
+    valid_date = takeoff.astype("datetime64[D]")
+    return ec_track_for_day(valid_date).sel(time=slice(takeoff, landing))
+
+
+def nelder_mead_overpass(a_track, b_track, a_lon="lon", a_lat="lat", b_lon="lon", b_lat="lat"):
+    """
+    Time and distance of closest approach of two tracks found by Nelder-Mead optimization,
+    starting from the closest sample of `a_track`.
+
+    This is the method all published overpass events were computed with. Their event_ids
+    are hashed from these times, so overpass events keep using it, while `closest_approach`
+    solves the same problem exactly. Only the positions of the tracks are interpolated,
+    which gives the same result as interpolating whole datasets, only faster.
+
+    :returns: (distance [m], time)
+    """
+    import numpy as np
+    from scipy.optimize import minimize
+    from orcestra.flightplan import geod
+
+    a = a_track[[a_lat, a_lon]].sel(time=slice(*b_track.time[[0, -1]]))
+    b = b_track[[b_lat, b_lon]].interp(time=a.time)
+    _, _, dist = geod.inv(b[b_lon], b[b_lat], a[a_lon], a[a_lat])
+    i = dist.argmin()
 
-        _a = a.assign_coords(time=(a.time - t_guess) / t_unit)
-        _b = b.assign_coords(time=(b.time - t_guess) / t_unit)
+    t_guess = a.time.values[i]
+    t_unit = np.timedelta64(1000_000_000, "ns")
 
-        def cost(t):
-            t = float(t[0])
-            a = _a.interp(time=t, method="linear")
-            b = _b.interp(time=t, method="linear")
-            _, _, dist = geod.inv(b[b_lon], b[b_lat], a[a_lon], a[a_lat])
-            return dist
+    _a = a.assign_coords(time=(a.time - t_guess) / t_unit)
+    _b = b.assign_coords(time=(b.time - t_guess) / t_unit)
 
-        res = minimize(cost, 0., method="Nelder-Mead")
-        t = float(res.x[0])
+    def cost(t):
+        t = float(t[0])
         a = _a.interp(time=t, method="linear")
         b = _b.interp(time=t, method="linear")
         _, _, dist = geod.inv(b[b_lon], b[b_lat], a[a_lon], a[a_lat])
-        return float(dist), t_guess + t * t_unit
-    else:
-        return float(dist[i]), a.time.values[i]
-
-
-def flight_id2datestr(flight_id):
-    d = flight_id.split("-")[1][:-1]
-    return d[:4] + "-" + d[4:6] + "-" + d[6:]
+        return dist
 
+    res = minimize(cost, 0., method="Nelder-Mead")
+    t = float(res.x[0])
+    a = _a.interp(time=t, method="linear")
+    b = _b.interp(time=t, method="linear")
+    _, _, dist = geod.inv(b[b_lon], b[b_lat], a[a_lon], a[a_lat])
+    return float(dist), t_guess + t * t_unit
 
-def get_ec_track(flight_id, ds):
-    import orcestra.sat
+def overpass(ds, track):
+    """
+    :returns: (distance [m], time) of the overpass event of the flight track `ds` and `track`,
+              see `nelder_mead_overpass`. Results are cached by the positions of both tracks.
+    """
+    import json
+    import hashlib
     import numpy as np
-    import warnings
-    takeoff, landing, _ = get_takeoff_landing(flight_id, ds)
-    valid_date = takeoff.astype("datetime64[D]")
-    issue_dates = [valid_date - np.timedelta64(i, 'D') for i in range(0, 6)]
-    if np.datetime64(valid_date) > np.datetime64("2024-11-01T00:00:00"):
-        roi = "EUR"
-    elif np.datetime64(valid_date) >= np.datetime64("2024-09-07T00:00:00"):
-        roi = "BARBADOS" # region of interest
-    else:
-        roi = "CAPE_VERDE"
-    for issue_date in issue_dates:
-        try:
-            ec_track = orcestra.sat.SattrackLoader(
-                "EARTHCARE", issue_date, kind="PRE",roi=roi
-            ).get_track_for_day(valid_date).sel(time=slice(takeoff, landing))
-            break
-        except:
-            warnings.warn("No sattrack forecast issued on flightday, " +
-                          "I will use an older sattrack forecast!")
-            continue
-    return ec_track
-
+    from localcache import cache_dir, DiskLRU
+
+    h = hashlib.sha256()
+    for track_ in [ds, track]:
+        for v in ["time", "lat", "lon"]:
+            h.update(np.ascontiguousarray(track_[v].values).tobytes())
+    key = f"{h.hexdigest()}/overpass"
+    cache = DiskLRU(cache_dir("overpass"), "10M")
+    data = cache.get(key)
+    if data is not None:
+        dist, time = json.loads(data)
+        return dist, np.datetime64(time, "ns")
+    dist, time = nelder_mead_overpass(ds, track)
+    cache.put(key, json.dumps([dist, str(np.datetime64(time, "ns"))]).encode("utf-8"))
+    return dist, time
 
 def ec_event(ds, ec_track, ec_remarks=None):
-    dist, time = get_overpass_track(ds, ec_track)
+    dist, time = overpass(ds, ec_track)
     return {"name": "EC meeting point",
             "time": to_dt(time),
             "kinds": ["ec_underpass"],
@@ -135,8 +335,14 @@ def ec_event(ds, ec_track, ec_remarks=None):
             "remarks": ec_remarks or [],
            }
 
-def pace_event(ds, pace_track, remarks=None):
-    dist, time = get_overpass_track(ds, pace_track)
+def pace_event(ds, pace_track=None, remarks=None):
+    """
+    :param pace_track: PACE track, loaded for the flight track `ds` if None
+    """
+    if pace_track is None:
+        from get_pace import pace_track_near
+        pace_track = pace_track_near(ds)
+    dist, time = overpass(ds, pace_track)
     return {"name": "PACE meeting point",
             "time": to_dt(time),
             "kinds": ["pace_underpass"],
@@ -147,7 +353,7 @@ def pace_event(ds, pace_track, remarks=None):
 
 def meteor_event(ds, meteor_track, seg=None, name=None, remarks=None):
     if seg: ds = ds.sel(time=parse_segment(seg)["slice"])
-    dist, meeting_time = get_overpass_track(ds, meteor_track)
+    dist, meeting_time = overpass(ds, meteor_track)
     return {"name": name or "METEOR overpass",
             "time": to_dt(meeting_time),
             "kinds": ["meteor_overpass"],
@@ -158,24 +364,23 @@ def meteor_event(ds, meteor_track, seg=None, name=None, remarks=None):
            }
 
 
+def overpass_targets():
+    """
+    :returns: lat, lon, event name and kinds of fixed overpass targets by target name
+    """
+    from orcestra.flightplan import bco, mindelo
+    return {
+        "BCO": (bco.lat, bco.lon, "BCO overpass", ["bco_overpass"]),
+        "CVAO": (mindelo.lat, mindelo.lon, "CVAO overpass", ["cvao_overpass"]),
+        "MIM": (48.14778, 11.57333, "MIM overpass", ["mim_overpass"]),
+    }
+
+
 def target_event(ds, target=None, target_lat=None, target_lon=None,
                  seg=None, name=None, kinds=None, remarks=None):
-    if target=="BCO":
-        from orcestra.flightplan import bco
-        target_lat, target_lon = bco.lat, bco.lon
-        target_name = "BCO overpass"
-        target_kinds = ["bco_overpass"]
-
-    elif target=="CVAO":
-        from orcestra.flightplan import mindelo
-        target_lat, target_lon = mindelo.lat, mindelo.lon
-        target_name = "CVAO overpass"
-        target_kinds = ["cvao_overpass"]
-
-    elif target=="MIM":
-        target_lat, target_lon = 48.14778, 11.57333
-        target_name = "MIM overpass"
-        target_kinds = ["mim_overpass"]
+    targets = overpass_targets()
+    if target in targets:
+        target_lat, target_lon, target_name, target_kinds = targets[target]
 
     elif (target is None) and ((target_lat is None) or (target_lon is None)):
         print("You need to specify either a target, i.e. BCO, CVAO, MIM or a target_lat and target_lon")
@@ -184,8 +389,7 @@ def target_event(ds, target=None, target_lat=None, target_lon=None,
         target_name = "target meeting point"
         target_kinds = ["point_overpass"]
     
-    if seg: ds = ds.sel(time=parse_segment(seg)["slice"])
-    dist, time = get_overpass_point(ds, target_lat, target_lon)
+    [(dist, time)] = get_overpass_points(ds, [(target_lat, target_lon)], seg=seg or None)
 
     return {"name": name or target_name,
             "time": to_dt(time),
@@ -195,35 +399,62 @@ def target_event(ds, target=None, target_lat=None, target_lon=None,
            }
 
 
-def fit_circle(lat, lon):
+def fit_circle(lat, lon, x0=None):
     """
     Given a sequence of WGS84-Coordinates (lat and lon) on points along a circular path,
     this function determines the center and radius of that circle.
+    Optionally, an initial guess `x0` = (clat, clon) of the center can be given.
     """
     from orcestra.flightplan import geod
-    from scipy.optimize import minimize
+    from scipy.optimize import least_squares
     import numpy as np
 
     lat = np.asarray(lat)
     lon = np.asarray(lon)
 
-    clat = np.mean(lat)
-    clon = np.mean(lon)
+    if x0 is None:
+        x0 = [np.mean(lat), np.mean(lon)]
 
-    def cost(x):
+    def residuals(x):
         clat, clon = x
         _, _, d = geod.inv(lon, lat, np.full_like(lon, clon), np.full_like(lat, clat))
-        return np.std(d)
+        return d - np.mean(d)
 
-    res = minimize(cost, [clat, clon], method="Nelder-Mead")
+    res = least_squares(residuals, x0, method="lm", x_scale=1e-3)
     clat, clon = res.x
     _, _, d = geod.inv(lon, lat, np.full_like(lon, clon), np.full_like(lat, clat))
     return float(clat), float(clon), float(np.mean(d))
 
+def circumcircles(x, y):
+    """
+    Center and radius of the circles through triples of points in a plane.
+
+    :param x: array of shape (..., 3)
+    :param y: array of shape (..., 3)
+    :returns: cx, cy, r of shape (...), NaN for collinear points
+    """
+    import numpy as np
+    ax, bx, cx = np.moveaxis(x, -1, 0)
+    ay, by, cy = np.moveaxis(y, -1, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        d = 2 * (ax * (by - cy) + bx * (cy - ay) + cx * (ay - by))
+        a2 = ax**2 + ay**2
+        b2 = bx**2 + by**2
+        c2 = cx**2 + cy**2
+        ux = (a2 * (by - cy) + b2 * (cy - ay) + c2 * (ay - by)) / d
+        uy = (a2 * (cx - bx) + b2 * (ax - cx) + c2 * (bx - ax)) / d
+        r = np.hypot(ax - ux, ay - uy)
+    bad = ~np.isfinite(r)
+    return np.where(bad, np.nan, ux), np.where(bad, np.nan, uy), np.where(bad, np.nan, r)
+
 def ransac_fit_circle(lat, lon, distance_range=1e3, n=100):
     """
     Given a sequence of WGS84-Coordinates (lat and lon) on points along a circular path,
     this function determines the center and radius of that circle.
+
+    All `n` RANSAC hypotheses are circles through three random points, which are
+    solved at once in an azimuthal equidistant plane around the mean position.
+    The inliers of the best hypothesis are refined on the ellipsoid by `fit_circle`.
     """
     import numpy as np
     from orcestra.flightplan import geod
@@ -231,22 +462,151 @@ def ransac_fit_circle(lat, lon, distance_range=1e3, n=100):
     lat = np.asarray(lat)
     lon = np.asarray(lon)
     rng = np.random.default_rng(12345)
+    idxs = np.array([rng.choice(len(lat), 3, replace=False) for _ in range(n)])
 
-    samples = []
-    for _ in range(n):
-        idxs = rng.choice(len(lat), 3, replace=False)
+    lat0, lon0 = np.mean(lat), np.mean(lon)
+    az, _, d = geod.inv(np.full_like(lon, lon0), np.full_like(lat, lat0), lon, lat)
+    x = d * np.sin(np.radians(az))
+    y = d * np.cos(np.radians(az))
 
-        clat, clon, radius = fit_circle(lat[idxs], lon[idxs])
+    cx, cy, radius = circumcircles(x[idxs], y[idxs])
+    residual = np.abs(np.hypot(x - cx[:, np.newaxis], y - cy[:, np.newaxis]) - radius[:, np.newaxis])
+    n_in = np.where(np.isfinite(radius), np.sum(residual <= distance_range, axis=1), -1)
 
-        _, _, d = geod.inv(lon, lat, np.full_like(lon, clon), np.full_like(lat, clat))
-        n_in = np.sum(np.abs(radius - d) <= distance_range)
+    clon, clat, _ = geod.fwd(np.full_like(cx, lon0), np.full_like(cy, lat0),
+                             np.degrees(np.arctan2(np.nan_to_num(cx), np.nan_to_num(cy))),
+                             np.nan_to_num(np.hypot(cx, cy)))
+    # best hypothesis, ties are broken like sorting (n_in, clat, clon, radius) tuples
+    best = np.lexsort((np.nan_to_num(radius), clon, clat, n_in))[-1]
+    good = residual[best] <= distance_range
+    return fit_circle(lat[good], lon[good], x0=[clat[best], clon[best]])
 
-        samples.append((n_in, clat, clon, radius))
 
-    n_in_good, clat, clon, radius = sorted(samples)[-1]
-    _, _, d = geod.inv(lon, lat, np.full_like(lon, clon), np.full_like(lat, clat))
-    good = np.abs(radius - d) <= distance_range
-    return fit_circle(lat[good], lon[good])
+def _navdata_rates(ds, window):
+    """time, unwrapped heading [deg], smoothed turn rate [deg/s] and vertical speed [m/s] of a flight"""
+    import numpy as np
+    from flightphases import centered_rate
+    time = ds.time.values.astype("datetime64[ns]")
+    heading = ds.heading.values.astype(float)
+    valid = np.isfinite(heading)
+    # unwrapped heading, gaps are filled with the preceding heading
+    filled = heading[np.maximum.accumulate(np.where(valid, np.arange(len(heading)), 0))]
+    unwrapped = np.degrees(np.unwrap(np.radians(np.nan_to_num(filled))))
+    turn_rate = centered_rate(time, unwrapped, window)
+    vertical_speed = centered_rate(time, ds.alt.values.astype(float), window)
+    return time, unwrapped, turn_rate, vertical_speed
+
+
+def _rolling_mean(values, window):
+    """centered running mean over `window` samples, ignoring NaN"""
+    import numpy as np
+    valid = np.isfinite(values)
+    s = np.concatenate([[0.], np.cumsum(np.where(valid, values, 0.))])
+    n = np.concatenate([[0], np.cumsum(valid)])
+    i = np.arange(len(values))
+    i0 = np.maximum(i - window // 2, 0)
+    i1 = np.minimum(i + window // 2 + 1, len(values))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (s[i1] - s[i0]) / (n[i1] - n[i0])
+
+
+# range of absolute turn rates [deg/s] on circles
+CIRCLE_TURN_RATE = (.05, .5)
+
+
+def navdata_change_points(ds, window=120, turn_rate=CIRCLE_TURN_RATE[0], vertical_speed=2.):
+    """
+    Times at which turns and climbs or descents begin and end.
+
+    :param ds: navdata of the flight (time, heading, alt)
+    :param window: number of samples over which turn rate and vertical speed are smoothed
+    :param turn_rate: minimum absolute turn rate [deg/s] of turns, by default the slowest
+                      circle turn rate, such that change points mark circle boundaries
+    :param vertical_speed: minimum absolute vertical speed [m/s] of climbs and descents
+    :returns: dict with sorted arrays of "turn" and "altitude" change times
+    """
+    import numpy as np
+    from flightphases import runs
+    time, _, rate, vs = _navdata_rates(ds, window)
+
+    def edges(mask):
+        start, end = runs(mask)
+        return np.sort(np.concatenate([time[start], time[end - 1]]))
+
+    return {"turn": edges(np.abs(rate) > turn_rate),
+            "altitude": edges(np.abs(vs) > vertical_speed)}
+
+
+def propose_segments(ds, window=120,
+                     min_leg_duration=600, max_leg_turn_rate=.02, max_leg_roll=2.5,
+                     min_circle_duration=1200, circle_turn_rate=CIRCLE_TURN_RATE,
+                     min_circle_heading_change=270., max_circle_residual=2e3,
+                     max_level_vertical_speed=1.):
+    """
+    Proposes `straight_leg`, `circle` and level change (`ascent`, `descent`) segments
+    of a flight from its navdata, as a starting point for the segmentation.
+
+    Turn rate, vertical speed and roll are smoothed over `window` samples at once,
+    and segments are runs of samples fulfilling the conditions of their kind.
+    Circle candidates are confirmed by a RANSAC circle fit.
+
+    :param ds: 1 s navdata of the flight (time, lat, lon, alt, heading and optionally roll)
+    :param min_leg_duration: minimum duration [s] of straight legs
+    :param max_leg_turn_rate: maximum absolute turn rate [deg/s] on straight legs
+    :param max_leg_roll: maximum absolute mean roll [deg] on straight legs
+    :param min_circle_duration: minimum duration [s] of circles
+    :param circle_turn_rate: range of absolute turn rates [deg/s] on circles
+    :param min_circle_heading_change: minimum heading change [deg] of circles
+    :param max_circle_residual: maximum standard deviation [m] of the distance to the fitted circle center
+    :param max_level_vertical_speed: maximum absolute vertical speed [m/s] on legs and circles
+    :returns: list of (slice, kinds) tuples in order of start, as accepted by `parse_segment`
+    """
+    import numpy as np
+    from orcestra.flightplan import geod
+    from flightphases import runs, VERTICAL_SPEED, MIN_VERTICAL_DURATION
+
+    time, heading, turn_rate, vs = _navdata_rates(ds, window)
+    lat = ds.lat.values.astype(float)
+    lon = ds.lon.values.astype(float)
+    alt = ds.alt.values.astype(float)
+    if "roll" in ds:
+        roll = _rolling_mean(ds["roll"].values.astype(float), window)
+    else:
+        roll = np.zeros(len(time))
+
+    with np.errstate(invalid="ignore"):
+        airborne = np.isfinite(lat) & np.isfinite(lon) & (alt > np.nanmin(alt) + 300)
+        level = airborne & (np.abs(vs) < max_level_vertical_speed)
+        straight = level & (np.abs(turn_rate) < max_leg_turn_rate) & (np.abs(roll) < max_leg_roll)
+        circling = level & (np.abs(turn_rate) >= circle_turn_rate[0]) & (np.abs(turn_rate) <= circle_turn_rate[1])
+
+    def periods(mask, min_duration):
+        start, end = runs(mask)
+        keep = time[end - 1] - time[start] >= np.timedelta64(int(min_duration), "s")
+        return zip(start[keep], end[keep])
+
+    def segment(i0, i1, kinds):
+        return (slice(np.datetime64(time[i0], "s"), np.datetime64(time[i1 - 1], "s")), kinds)
+
+    segments = [segment(i0, i1, ["straight_leg"]) for i0, i1 in periods(straight, min_leg_duration)]
+
+    for sign, kind in [(1, "circle_clockwise"), (-1, "circle_counterclockwise")]:
+        for i0, i1 in periods(circling & (np.sign(turn_rate) == sign), min_circle_duration):
+            if abs(heading[i1 - 1] - heading[i0]) < min_circle_heading_change:
+                continue
+            step = max((i1 - i0) // 360, 1)
+            clat, clon, _ = ransac_fit_circle(lat[i0:i1:step], lon[i0:i1:step])
+            _, _, d = geod.inv(lon[i0:i1:step], lat[i0:i1:step],
+                               np.full_like(lon[i0:i1:step], clon), np.full_like(lat[i0:i1:step], clat))
+            if np.std(d) <= max_circle_residual:
+                segments.append(segment(i0, i1, ["circle", kind]))
+
+    min_vertical = MIN_VERTICAL_DURATION / np.timedelta64(1, "s")
+    with np.errstate(invalid="ignore"):
+        segments += [segment(i0, i1, ["ascent"]) for i0, i1 in periods(vs > VERTICAL_SPEED, min_vertical)]
+        segments += [segment(i0, i1, ["descent"]) for i0, i1 in periods(vs < -VERTICAL_SPEED, min_vertical)]
+
+    return sorted(segments, key=lambda s: s[0].start)
 
 
 def _attach_circle_fit(segment, ds):
@@ -272,51 +632,24 @@ def to_dt(dt64):
     return pd.Timestamp(dt64).to_pydatetime(warn=False)
 
 def wgs84_altitude_takeoff(flight_id, ds):
-    import numpy as np
-    if (ds.time[0].values < np.datetime64("2024-08-10T00:00:00") or                     # Transfer flight to Sal
-        (ds.time[0].values > np.datetime64("2024-11-01T00:00:00") and "b" in flight_id) # Two November flights
-        ):
-        wgs84_altitude_takeoff = 681   #Memmingen
-    elif ds.time[0].values > np.datetime64("2024-11-01T00:00:00"):                       # All other November flights
-        wgs84_altitude_takeoff = 630   #Oberpfaffenhofen
-    elif (ds.time[0].values >= np.datetime64("2024-08-10T00:00:00") and                  
-          ds.time[0].values < np.datetime64("2024-09-07T00:00:00")
-         ):
-        wgs84_altitude_takeoff = 90    #Sal
-    elif ds.time[0].values >= np.datetime64("2024-09-07T00:00:00"):
-        wgs84_altitude_takeoff = 9     #Barbados
-    return wgs84_altitude_takeoff
+    from flightphases import airport, TAKEOFF_AIRPORTS, AIRPORT_ALTITUDES
+    return AIRPORT_ALTITUDES[airport(TAKEOFF_AIRPORTS, flight_id, ds.time[0].values)]
 
 def wgs84_altitude_landing(flight_id, ds):
-    import numpy as np
-    if ds.time[-1].values < np.datetime64("2024-09-05T00:00:00"):
-        wgs84_altitude_landing = 90    #Sal
-    elif (ds.time[-1].values >= np.datetime64("2024-09-05T00:00:00") and
-          ds.time[-1].values < np.datetime64("2024-09-29T00:00:00")
-         ):
-        wgs84_altitude_landing = 9     #Barbados
-    elif ds.time[-1].values > np.datetime64("2024-11-01T00:00:00"):                     # All other November flights
-        wgs84_altitude_landing = 630   #Oberpfaffenhofen
-    elif ds.time[-1].values >= np.datetime64("2024-09-30T00:00:00") and ds.time[-1].values <= np.datetime64("2024-09-30T23:59:59"):                          # Transfer back from Barbados
-        wgs84_altitude_landing = 681   #Memmingen
-    return wgs84_altitude_landing
+    from flightphases import airport, LANDING_AIRPORTS, AIRPORT_ALTITUDES
+    return AIRPORT_ALTITUDES[airport(LANDING_AIRPORTS, flight_id, ds.time[-1].values)]
 
 
 def get_takeoff_landing(flight_id, ds):
     """
     Detect take-off and landing for the airport on Sal and Barbados
     which are located at about 89m and 8m above WGS84 respectively.
+
+    Further flight phases are available from `flightphases.flight_phases`.
     """
-    import numpy as np
-    takeoff_alt = wgs84_altitude_takeoff(flight_id, ds)
-    landing_alt = wgs84_altitude_landing(flight_id, ds)    
-    takeoff = ds["time"].where(ds.alt > takeoff_alt, drop=True)[0].values
-    if len(ds["time"].where((ds.alt <= landing_alt) & (ds.time > takeoff), drop=True)) == 0: # handle exception of missing BAHAMAS data at end of flight
-        landing = ds["time"][-1].values
-    else:
-        landing = ds["time"].where((ds.alt <= landing_alt) & (ds.time > takeoff), drop=True)[0].values
-    duration = (landing - takeoff).astype("timedelta64[m]").astype(int)
-    return takeoff, landing, duration
+    from flightphases import flight_phases
+    phases = flight_phases(flight_id, ds)
+    return phases["takeoff"], phases["landing"], phases["duration"]
 
 def segment_hash(segment):
     import hashlib
@@ -346,14 +679,15 @@ def parse_segment(segment):
     return seg
 
 def to_yaml(platform, flight_id, ds, segments, events):
+    from flightphases import flight_phases
     segments = attach_circle_fit([parse_segment(s) for s in segments], ds)
-    takeoff, landing, _ = get_takeoff_landing(flight_id, ds)
+    phases = flight_phases(flight_id, ds)
     return {"mission": "ORCESTRA",
             "platform": platform,
             "flight_id": flight_id,
-            "takeoff": to_dt(takeoff),
-            "landing": to_dt(landing),
-            "events": [{"event_id": f"{flight_id}_{event_hash(e)}",
+            "takeoff": to_dt(phases["takeoff"]),
+            "landing": to_dt(phases["landing"]),
+            "events": [{"event_id": e.get("event_id") or f"{flight_id}_{event_hash(e)}",
                         "name": None,
                         "time": to_dt(e["time"]),
                         "kinds": [],
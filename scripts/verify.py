@@ -1,4 +1,7 @@
 import os
+import sys
+import json
+import hashlib
 import logging
 import traceback
 import yaml
@@ -6,44 +9,146 @@ import numpy as np
 from contextlib import closing
 
 
-from navdata import get_navdata
-from checkers import FlightChecker
+from navdata import get_navdata, get_navdata_source
+from checkers import FlightChecker, CHECKER_VERSION
+from localcache import cache_dir, DiskLRU
+from sondes import SondeIndex, load_sonde_info, default_table_file
 
-def validate(segment_file, sonde_info):
+def collect_warnings(segment_file, sonde_info):
+    """
+    checks a flight segment file without logging
+
+    :param segment_file: flight segment file to check
+    :param sonde_info: SondeIndex of all sondes
+    :returns: dict of flight warnings, list of (segment_id, warnings) and
+              the error message and traceback if checking failed
+    """
+    result = {"flight_warnings": [], "segment_warnings": [], "error": None}
+    try:
+        flightdata = yaml.load(open(segment_file), Loader=yaml.SafeLoader)
+        result["flight_warnings"] = list(FlightChecker(flightdata).check_flight(flightdata))
+        sondes = sonde_info.for_flight(flightdata["platform"], flightdata["flight_id"])
+
+        with closing(get_navdata(flightdata["platform"], flightdata["flight_id"]).load()) as navdata:
+            checker = FlightChecker(flightdata, navdata)
+            for seg in flightdata["segments"]:
+                t_start = np.datetime64(seg["start"])
+                t_end = np.datetime64(seg["end"])
+                seg_navdata = navdata.sel(time=slice(t_start, t_end))
+
+                sondes_by_flag = sondes.by_flag(seg["start"], seg["end"])
+
+                warnings = list(checker.check_segment(seg, seg_navdata, sondes_by_flag))
+                result["segment_warnings"].append((seg.get("segment_id"), warnings))
+    except Exception as e:
+        result["error"] = (str(e), traceback.format_exc())
+    return result
+
+
+def log_warnings(result):
+    """
+    logs the result of `collect_warnings`
+
+    :returns: number of flight and segment warnings
+    :raises RuntimeError: if checking the file failed
+    """
     flightlogger = logging.getLogger("flight")
     segmentlogger = logging.getLogger("segment")
 
-    flightdata = yaml.load(open(segment_file), Loader=yaml.SafeLoader)
-    checker = FlightChecker(flightdata)
-    sonde_info = [s for s in sonde_info if s["platform"] == flightdata["platform"]]
-
-    flight_warnings = list(checker.check_flight(flightdata))
-    for warning in flight_warnings:
+    for warning in result["flight_warnings"]:
         flightlogger.warning(warning)
 
     segment_warning_count = 0
-    with closing(get_navdata(flightdata["platform"], flightdata["flight_id"]).load()) as navdata:
-        for seg in flightdata["segments"]:
-            t_start = np.datetime64(seg["start"])
-            t_end = np.datetime64(seg["end"])
-            seg_navdata = navdata.sel(time=slice(t_start, t_end))
+    for segment_id, warnings in result["segment_warnings"]:
+        for warning in warnings:
+            if segment_id is not None:
+                segmentlogger.warning(segment_id)
+            segmentlogger.warning(warning)
+        segment_warning_count += len(warnings)
+
+    if result["error"] is not None:
+        message, tb = result["error"]
+        print(tb, end="", file=sys.stderr)
+        raise RuntimeError(message)
+
+    return len(result["flight_warnings"]), segment_warning_count
 
-            sondes_in_segment = [s
-                                 for s in sonde_info
-                                 if s["launch_time"] >= seg["start"]
-                                 and s["launch_time"] < seg["end"]]
-            sondes_by_flag = {f: [s for s in sondes_in_segment if s["flag"] == f]
-                              for f in set(s["flag"] for s in sondes_in_segment)}
 
-            warnings = list(checker.check_segment(seg, seg_navdata, sondes_by_flag))
-            for warning in warnings:
-                if "segment_id" in seg:
-                    segmentlogger.warning(seg["segment_id"])
-                segmentlogger.warning(warning)
+def validate(segment_file, sonde_info):
+    """
+    :param segment_file: flight segment file to check
+    :param sonde_info: SondeIndex of all sondes
+    """
+    return log_warnings(collect_warnings(segment_file, sonde_info))
+
+
+_worker_sonde_info = None
+
+def _init_worker(sonde_info):
+    global _worker_sonde_info
+    _worker_sonde_info = sonde_info
+
+def _collect_warnings(segment_file):
+    return collect_warnings(segment_file, _worker_sonde_info)
+
+def _collect_uncached_warnings(segment_files, sonde_info, jobs=1):
+    if jobs > 1 and len(segment_files) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(sonde_info,)) as pool:
+            yield from pool.map(_collect_warnings, segment_files)
+    else:
+        for segment_file in segment_files:
+            yield collect_warnings(segment_file, sonde_info)
+
 
-            segment_warning_count += len(warnings)
+def result_key(segment_file, sonde_info_hash):
+    """
+    Key of the verification result of a segment file, derived from the content of
+    the segment file, the navdata source, the sonde info and the checker version.
 
-    return len(flight_warnings), segment_warning_count
+    :returns: the key or None if the file can not be identified
+    """
+    try:
+        with open(segment_file, "rb") as f:
+            content = f.read()
+        flightdata = yaml.load(content, Loader=yaml.SafeLoader)
+        navdata_source = get_navdata_source(flightdata["platform"], flightdata["flight_id"])
+    except Exception:
+        return None
+    return "\n".join([hashlib.sha256(content).hexdigest(),
+                      navdata_source,
+                      sonde_info_hash,
+                      f"checker version {CHECKER_VERSION}"])
+
+
+def collect_all_warnings(segment_files, sonde_info, jobs=1, cache=None, sonde_info_hash="", force=False):
+    """
+    yields the results of `collect_warnings` in order of `segment_files`,
+    checking `jobs` files concurrently in worker processes if `jobs` > 1
+
+    :param cache: optional DiskLRU of previous results, unchanged files are
+                  not checked again unless `force` is set
+    :param sonde_info_hash: identifies the content of `sonde_info` for the cache
+    """
+    keys = [None] * len(segment_files)
+    cached = {}
+    if cache is not None:
+        keys = [result_key(f, sonde_info_hash) for f in segment_files]
+        if not force:
+            cached = {i: json.loads(data)
+                      for i, key in enumerate(keys)
+                      if key is not None and (data := cache.get(key)) is not None}
+
+    uncached = _collect_uncached_warnings([f for i, f in enumerate(segment_files) if i not in cached],
+                                          sonde_info, jobs=jobs)
+    for i, key in enumerate(keys):
+        if i in cached:
+            yield cached[i]
+            continue
+        result = next(uncached)
+        if cache is not None and key is not None and result["error"] is None:
+            cache.put(key, json.dumps(result).encode("utf-8"))
+        yield result
 
 
 def _main():
@@ -54,30 +159,45 @@ def _main():
         logging.basicConfig(format='%(levelname)s %(name)s: %(message)s', level=logging.WARNING)
     mainlogger = logging.getLogger("main")
 
-    basedir = os.path.abspath(os.path.dirname(__file__))
-
     import tqdm
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("infiles", type=str, nargs="+")
-    parser.add_argument("-s", "--sonde_info", help="sonde info yaml file", default=os.path.join(basedir, "sondes.yaml"))
+    parser.add_argument("-s", "--sonde_info", help="sonde info yaml file or sonde table (default: local sonde table)", default=default_table_file())
+    parser.add_argument("--no-sondes", action="store_true", help="do not check sondes, e.g. if no sonde info is available")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of files checked concurrently")
+    parser.add_argument("-f", "--force", action="store_true", help="check all files, even if a cached result exists")
+    parser.add_argument("--no-cache", action="store_true", help="neither use nor store cached results")
     args = parser.parse_args()
 
-    sonde_info = yaml.load(open(args.sonde_info), Loader=yaml.SafeLoader)
+    if args.no_sondes:
+        sonde_info_content = b""
+        sonde_info = SondeIndex([])
+    elif os.path.exists(args.sonde_info):
+        with open(args.sonde_info, "rb") as f:
+            sonde_info_content = f.read()
+        sonde_info = SondeIndex(load_sonde_info(args.sonde_info))
+    else:
+        parser.error(f"no sonde info at {args.sonde_info}, run sondes.py to build the sonde table, "
+                     "pass another one with -s or skip sonde checks with --no-sondes")
+
+    cache = None if args.no_cache else DiskLRU(cache_dir("verify"), "100M")
 
     total_warnings = 0
-    for filename in tqdm.tqdm(args.infiles):
+    results = collect_all_warnings(args.infiles, sonde_info, jobs=args.jobs,
+                                   cache=cache,
+                                   sonde_info_hash=hashlib.sha256(sonde_info_content).hexdigest(),
+                                   force=args.force)
+    for filename, result in tqdm.tqdm(zip(args.infiles, results), total=len(args.infiles)):
         mainlogger.info("verifying %s", filename)
         try:
-            flight_warning_count, segment_warning_count = validate(
-                        filename, sonde_info)
+            flight_warning_count, segment_warning_count = log_warnings(result)
             total_warnings += flight_warning_count + segment_warning_count
             mainlogger.info("%d flight warnings, %d segment warnings",
                             flight_warning_count,
                             segment_warning_count)
         except Exception as e:
             total_warnings += 1
-            traceback.print_exc()
             mainlogger.error("exception while processing segment file %s: %s",
                              filename, e)
 